@@ -1,20 +1,233 @@
 import fulcrane
+from fulcrane.controller import (ACCESS_CODE_MAP, MIN_THRESHOLD, MonitorCycle,
+                                 set_request_properties)
+from fulcrane.pose_channel import PosePublisher
 import numpy as np
+import argparse
 import asyncio
-from numpy import linalg as LA
+import struct
 import sys
+import time
 
-async def main():
-    ip = '192.168.0.51'
-    controller = await fulcrane.Controller.create(ip)
-    def position_callback(pos):
-        with open("angle_data.txt","w") as f:
-            f.write(f"{pos[4]:.16f},{pos[3]:.16f},{pos[5]:.16f}\n")
-        # sys.stdout.write(f"{pos[3]:.16f},{pos[4]:.16f},{pos[5]:.16f}\n")
-        # sys.stdout.flush()
-        return False
-    await controller.notify_joint_angle(position_callback, timeout=50)
-    controller.transport.close()
-
-if __name__=="__main__":
-    asyncio.run(main())
+NPY_HEADER_SIZE = 256
+
+
+def variable_width(name):
+    # number of values the controller sends for the variable
+    return set_request_properties(*ACCESS_CODE_MAP[name], 1)[2]
+
+
+def parse_variable(text):
+    # NAME or NAME:AXES with comma separated 0-based axes,
+    # e.g. AcsAxisTheta:4,3,5
+    name, _, axes = text.partition(':')
+    if name not in ACCESS_CODE_MAP:
+        raise argparse.ArgumentTypeError(f"unknown variable {name}")
+    if axes == "":
+        return name, None
+    axes = [int(axis) for axis in axes.split(',')]
+    width = variable_width(name)
+    if any(axis < 0 or axis >= width for axis in axes):
+        raise argparse.ArgumentTypeError(
+            f"axes of {name} must be 0 to {width - 1}")
+    return name, axes
+
+
+def create_npy_header(dtype, shape):
+    # fixed size so the final row count can be written over it on close
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+        np.lib.format.dtype_to_descr(dtype), shape)
+    return (b"\x93NUMPY\x01\x00" + struct.pack('<H', NPY_HEADER_SIZE - 10) +
+            header.ljust(NPY_HEADER_SIZE - 11).encode('latin1') + b"\n")
+
+
+class SampleWriter(object):
+    # rows are buffered and written every flush_interval or when the buffer
+    # fills, never once per sample
+    def __init__(self, path, output_format, width, timestamp, capacity=4096):
+        self.path = path
+        self.output_format = output_format
+        self.width = width
+        self.timestamp = timestamp
+        if timestamp:
+            self.dtype = np.dtype([('timestamp', '<f8'),
+                                   ('values', '<f4', (width, ))])
+        else:
+            self.dtype = np.dtype(('<f4', (width, )))
+        self.rows = np.zeros(capacity, dtype=self.dtype)
+        self.count = 0
+        self.written = 0
+        self.latest = None
+        if output_format == "latest":
+            self.file = None
+        elif path == "-":
+            self.file = sys.stdout.buffer
+        else:
+            self.file = open(path, "wb")
+        if output_format == "npy":
+            self.file.write(create_npy_header(self.dtype.base, self.shape(0)))
+
+    def shape(self, count):
+        if self.timestamp:
+            return (count, )
+        return (count, self.width)
+
+    def write(self, values):
+        if self.timestamp:
+            self.rows[self.count] = (time.time(), values)
+        else:
+            self.rows[self.count] = values
+        self.count += 1
+        self.latest = values
+        if self.count == len(self.rows):
+            self.flush()
+
+    def flush(self):
+        if self.output_format == "latest":
+            # the file GetPose.cs polls only ever holds the newest sample
+            if self.latest is not None:
+                with open(self.path, "w") as f:
+                    f.write(",".join(f"{v:.16f}" for v in self.latest) + "\n")
+            self.count = 0
+            return
+        rows = self.rows[:self.count]
+        if self.output_format == "csv":
+            if self.timestamp:
+                text = "".join(
+                    f"{t:.6f}," + ",".join(f"{v:.7g}" for v in row) + "\n"
+                    for t, row in zip(rows['timestamp'], rows['values']))
+            else:
+                text = "".join(
+                    ",".join(f"{v:.7g}" for v in row) + "\n" for row in rows)
+            self.file.write(text.encode('ascii'))
+        else:
+            self.file.write(rows.tobytes())
+        self.written += self.count
+        self.count = 0
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        if self.file is None:
+            return
+        if self.output_format == "npy":
+            self.file.seek(0)
+            self.file.write(
+                create_npy_header(self.dtype.base, self.shape(self.written)))
+        if self.file is not sys.stdout.buffer:
+            self.file.close()
+
+
+async def stream(args):
+    controller = await fulcrane.Controller.create(args.ip, args.port)
+    variables = args.var or [("AcsAxisTheta", [4, 3, 5])]
+    widths = [
+        variable_width(name) if axes is None else len(axes)
+        for name, axes in variables
+    ]
+    offsets = np.cumsum([0] + widths)
+    row = np.zeros(offsets[-1], dtype=np.float32)
+    writer = SampleWriter(args.output, args.format, len(row), args.timestamp)
+    cycle = MonitorCycle[args.cycle]
+
+    def create_callback(index, axes):
+        # a row is emitted for every sample of the first variable, carrying
+        # the latest values of the others
+        target = row[offsets[index]:offsets[index + 1]]
+
+        def callback(values):
+            # single values arrive as scalars
+            target[:] = values if axes is None else np.atleast_1d(values)[axes]
+            if index == 0:
+                writer.write(row)
+            return False
+
+        return callback
+
+    try:
+        for index, (name, axes) in enumerate(variables):
+            await controller.monitor(*ACCESS_CODE_MAP[name],
+                                     create_callback(index, axes),
+                                     args.mech_id, cycle, args.threshold)
+        end = None if args.duration <= 0 else time.monotonic() + args.duration
+        while end is None or time.monotonic() < end:
+            await asyncio.sleep(args.flush_interval)
+            writer.flush()
+    except BrokenPipeError:
+        pass
+    finally:
+        # the final flush hits the same closed pipe
+        try:
+            writer.close()
+        except BrokenPipeError:
+            pass
+        controller.close()
+
+
+async def publish(args):
+    controller = await fulcrane.Controller.create(args.ip, args.port)
+    publisher = PosePublisher(args.publish)
+    try:
+        await publisher.subscribe(controller, args.mech_id,
+                                  MonitorCycle[args.cycle], args.threshold)
+        if args.duration <= 0:
+            await asyncio.Event().wait()
+        await asyncio.sleep(args.duration)
+    finally:
+        publisher.close()
+        controller.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="stream controller variables to a file or stdout")
+    parser.add_argument('--ip', default='192.168.0.51')
+    parser.add_argument('--port', type=int, default=9876)
+    parser.add_argument('--mech-id', type=int, default=1)
+    parser.add_argument('--var',
+                        type=parse_variable,
+                        action='append',
+                        help="NAME[:AXES], may be repeated "
+                        "(default AcsAxisTheta:4,3,5)")
+    parser.add_argument('--cycle',
+                        default='at5ms',
+                        choices=[c.name for c in MonitorCycle
+                                 if c != MonitorCycle.pull])
+    parser.add_argument('--threshold', type=float, default=MIN_THRESHOLD)
+    parser.add_argument('--duration',
+                        type=float,
+                        default=50.0,
+                        help="seconds to run, 0 runs until interrupted")
+    parser.add_argument('--format',
+                        default='latest',
+                        choices=['latest', 'binary', 'csv', 'npy'],
+                        help="latest rewrites a text file with the newest "
+                        "sample; binary writes packed little-endian float32 "
+                        "records")
+    parser.add_argument('--output',
+                        default=None,
+                        help="file path or - for stdout")
+    parser.add_argument('--timestamp',
+                        action='store_true',
+                        help="prefix each record with a float64 host time")
+    parser.add_argument('--flush-interval', type=float, default=0.01)
+    parser.add_argument('--publish',
+                        metavar='PATH',
+                        default=None,
+                        help="publish the pose through a shared memory file")
+    args = parser.parse_args()
+    if args.output is None:
+        args.output = "angle_data.txt" if args.format == "latest" else "-"
+    if args.format == "npy" and args.output == "-":
+        parser.error("npy output needs a file path")
+    try:
+        if args.publish is not None:
+            asyncio.run(publish(args))
+        else:
+            asyncio.run(stream(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
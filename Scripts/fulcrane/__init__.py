@@ -1,4 +1,5 @@
 from fulcrane.controller import Controller, MonitorCycle, MoveType, InterpolationType
+from fulcrane.fleet import Fleet
 
 
 def int_or_str(value):
@@ -0,0 +1,221 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import platform
+import struct
+import sys
+import time
+import numpy as np
+import fulcrane
+from fulcrane.controller import (
+    ACCESS_CODE_MAP, PACKET_MAGIC_NUMBER, Controller, MonitorCycle, MoveType,
+    XMLReplyType, create_access_payload, create_access_xml,
+    create_move_params, create_payload, decode_frame, get_access_xml_key,
+    get_reply_type, parse_xml_replies, parse_xml_value)
+from fulcrane.replay import Replay
+from fulcrane.simulator import Simulator, create_data_update_xml
+
+MONITOR_RATE = 200.0  # samples per second at MonitorCycle.at5ms
+
+
+def create_sample_frame():
+    key, flex_node = create_access_xml(*ACCESS_CODE_MAP["AcsAxisTheta"], 1,
+                                       MonitorCycle.at5ms, 0.01)
+    data_node = flex_node[0][0][0]
+    xml = create_data_update_xml(data_node, "r",
+                                 np.linspace(-90.0, 90.0, 6) + 0.123456)
+    return PACKET_MAGIC_NUMBER + struct.pack('<i', len(xml)) + xml
+
+
+def measure(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    elapsed = time.perf_counter() - start
+    return {
+        "us_per_call": elapsed / repeat * 1e6,
+        "calls_per_sec": repeat / elapsed
+    }
+
+
+def percentiles(samples):
+    samples = np.asarray(samples) * 1e6
+    return {
+        "count": len(samples),
+        "p50_us": float(np.percentile(samples, 50)),
+        "p99_us": float(np.percentile(samples, 99)),
+        "max_us": float(np.max(samples))
+    }
+
+
+def legacy_decode(frame):
+    for element in parse_xml_replies(frame):
+        if (get_reply_type(element) == XMLReplyType.data_update):
+            _, data_node = get_access_xml_key(element)
+            parse_xml_value(data_node)
+
+
+def bench_codec(repeat):
+    frame = create_sample_frame()
+    xml = frame[8:]
+    return {
+        "parse_xml_replies+get_reply_type+parse_xml_value":
+        measure(lambda: legacy_decode(frame), repeat),
+        "decode_frame_lxml":
+        measure(lambda: decode_frame(xml, False), repeat),
+        "decode_frame_fast":
+        measure(lambda: decode_frame(xml, True), repeat)
+    }
+
+
+def bench_payloads(repeat):
+    controller = Controller()
+    controller.sequid = 0
+    access = ACCESS_CODE_MAP["AcsAxisTheta"]
+    params = create_move_params(np.arange(6.0), "MoveJ", MoveType.thru)
+    return {
+        "create_access_xml+create_payload":
+        measure(
+            lambda: create_payload(
+                create_access_xml(*access, 1, MonitorCycle.pull, 0.01)[1]),
+            repeat),
+        "create_access_payload_cached":
+        measure(
+            lambda: create_access_payload(*access, 1, MonitorCycle.pull,
+                                          0.01), repeat),
+        "create_command_xml+create_payload":
+        measure(
+            lambda: create_payload(
+                controller.create_command_xml("MoveJ", params)[1]), repeat),
+        "create_command_payload":
+        measure(lambda: controller.create_command_payload("MoveJ", params),
+                repeat)
+    }
+
+
+async def bench_round_trips(repeat):
+    simulator = await Simulator.create(arms=1)
+    simulator.motor_on[:] = True
+    controller = await Controller.create('127.0.0.1', simulator.ports[0])
+    try:
+        access = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            await controller.get_joint_angle()
+            access.append(time.perf_counter() - start)
+        move = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            await controller.angulate_to(np.full(6, i % 10), MoveType.thru)
+            move.append(time.perf_counter() - start)
+    finally:
+        controller.close()
+        await simulator.close()
+    return {"access": percentiles(access), "move": percentiles(move)}
+
+
+def run_simulator(arms, connection):
+    async def serve():
+        simulator = await Simulator.create(arms=arms)
+        simulator.motor_on[:] = True
+        simulator.joint_target[:] = 1e9  # keep every value changing
+        connection.send(simulator.ports)
+        await asyncio.get_running_loop().run_in_executor(
+            None, connection.recv)
+        await simulator.close()
+
+    asyncio.run(serve())
+
+
+async def measure_monitor_rate(arms, duration):
+    # the simulator runs in its own process so this measures the client
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=run_simulator,
+                                      args=(arms, child))
+    process.start()
+    loop = asyncio.get_running_loop()
+    ports = await loop.run_in_executor(None, parent.recv)
+    controllers = []
+    received = [0]
+
+    def count(values):
+        received[0] += 1
+
+    try:
+        for port in ports:
+            controller = await Controller.create('127.0.0.1', port)
+            controllers.append(controller)
+            await controller.monitor(*ACCESS_CODE_MAP["AcsAxisTheta"], count,
+                                     1, MonitorCycle.at5ms, 0.0)
+        await asyncio.sleep(0.5)
+        received[0] = 0
+        start = time.perf_counter()
+        await asyncio.sleep(duration)
+        elapsed = time.perf_counter() - start
+        rate = received[0] / elapsed
+    finally:
+        for controller in controllers:
+            controller.close()
+        parent.send(None)
+        await loop.run_in_executor(None, process.join)
+    return rate / (arms * MONITOR_RATE)
+
+
+async def bench_monitor_capacity(max_arms, duration, tolerance):
+    results = []
+    sustained = 0
+    arms = 1
+    while (arms <= max_arms):
+        ratio = await measure_monitor_rate(arms, duration)
+        results.append({"subscriptions": arms, "delivered_ratio": ratio})
+        if (ratio < tolerance):
+            break
+        sustained = arms
+        arms *= 2
+    return {"max_sustained_at5ms_subscriptions": sustained, "steps": results}
+
+
+async def run(args):
+    results = {
+        "version": fulcrane.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "codec": bench_codec(args.repeat),
+        "payloads": bench_payloads(args.repeat),
+        "round_trips": await bench_round_trips(args.round_trips)
+    }
+    if (args.replay is not None):
+        # decoding throughput on captured production traffic
+        results["replay"] = Replay(args.replay).run()
+    if (args.max_subscriptions > 0):
+        results["monitor"] = await bench_monitor_capacity(
+            args.max_subscriptions, args.duration, args.tolerance)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fulcrane benchmarks")
+    parser.add_argument('--repeat', type=int, default=20000)
+    parser.add_argument('--round-trips', type=int, default=1000)
+    parser.add_argument('--max-subscriptions', type=int, default=256)
+    parser.add_argument('--duration', type=float, default=2.0)
+    parser.add_argument('--tolerance', type=float, default=0.95)
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--replay', default=None, help="capture file")
+    args = parser.parse_args()
+    # keep stdout machine-readable whatever the library prints meanwhile
+    with contextlib.redirect_stdout(sys.stderr):
+        results = asyncio.run(run(args))
+    text = json.dumps(results, indent=2)
+    if (args.output is None):
+        sys.stdout.write(text + "\n")
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
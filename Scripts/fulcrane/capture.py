@@ -0,0 +1,56 @@
+import struct
+import time
+
+CAPTURE_MAGIC = b"FCCP"
+CAPTURE_VERSION = 1
+FILE_HEADER = struct.Struct('<4sHH')
+# monotonic timestamp, flags, length of the raw bytes that follow
+RECORD_HEADER = struct.Struct('<dBI')
+
+CONTROL = 0
+MONITOR = 1
+INBOUND = 0
+OUTBOUND = 2
+
+
+class CaptureWriter(object):
+    # raw chunks are logged exactly as they crossed the socket, so a capture
+    # also reproduces how the controller split its frames
+    def __init__(self, path, clock=time.monotonic, buffering=1 << 20):
+        self.path = path
+        self.clock = clock
+        self.file = open(path, 'wb', buffering=buffering)
+        self.file.write(FILE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, 0))
+        self.records = 0
+
+    def record(self, channel, direction, data):
+        self.file.write(
+            RECORD_HEADER.pack(self.clock(), channel | direction, len(data)))
+        self.file.write(data)
+        self.records += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if (not self.file.closed):
+            self.file.close()
+
+
+def read_capture(path):
+    # yields (timestamp, channel, direction, data) for every record
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, _ = FILE_HEADER.unpack_from(data)
+    if (magic != CAPTURE_MAGIC or version != CAPTURE_VERSION):
+        raise ValueError("not a capture file: {}".format(path))
+    view = memoryview(data)
+    offset = FILE_HEADER.size
+    while (offset + RECORD_HEADER.size <= len(data)):
+        timestamp, flags, length = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        if (offset + length > len(data)):
+            break  # truncated by a crash while capturing
+        yield (timestamp, flags & MONITOR, flags & OUTBOUND,
+               view[offset:offset + length])
+        offset += length
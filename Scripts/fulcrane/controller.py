@@ -1,12 +1,23 @@
 from lxml import etree
 from enum import Enum
+from collections import namedtuple, deque
 import asyncio
-import queue
 import numpy as np
 from numpy import linalg as LA
 import struct
+import re
+import time
+import logging
+from functools import lru_cache
+from xml.sax.saxutils import escape
+from fulcrane.capture import CONTROL, INBOUND, MONITOR, OUTBOUND, CaptureWriter
+from fulcrane.stages import Pipeline
+from fulcrane.stats import ConnectionStats
+
+logger = logging.getLogger(__name__)
 
 PACKET_MAGIC_NUMBER = struct.pack('<i', 0x0001ba5e)
+FRAME_HEADER_SIZE = 8
 FLEX_GUI_NAMESPACE = {'ns': 'flex.gui'}
 MIN_THRESHOLD = np.finfo(np.float32).eps
 ACCESS_CODE_MAP = {
@@ -70,13 +81,24 @@ class MonitorCycle(Enum):
     pull = 10
 
 
+CYCLE_PERIODS = {
+    MonitorCycle.at5ms: 0.005,
+    MonitorCycle.at10ms: 0.01,
+    MonitorCycle.at50ms: 0.05,
+    MonitorCycle.at100ms: 0.1,
+    MonitorCycle.at200ms: 0.2,
+    MonitorCycle.at500ms: 0.5,
+    MonitorCycle.at1000ms: 1.0
+}
+
+
 def get_numpy_type(value_type):
     if value_type == XMLValueType.r:
         return np.float32
     if value_type == XMLValueType.i:
-        return np.int
+        return np.int64
     if value_type == XMLValueType.b:
-        return np.bool
+        return np.bool_
     raise ValueError
 
 
@@ -164,7 +186,7 @@ def create_access_xml(group, request_id, subid_base, mech_id, cycle,
     unit, mech_multiplier, count = set_request_properties(
         group, request_id, subid_base, mech_id)
     if (mech_multiplier < 0):
-        print("invalid access")
+        logger.warning("invalid access")
         return ""
 
     subid = subid_base + (mech_id - 1) * mech_multiplier
@@ -183,11 +205,35 @@ def create_access_xml(group, request_id, subid_base, mech_id, cycle,
     return (key, flex_node)
 
 
+def create_access_many_xml(accesses, mech_id, cycle, threshold):
+    # mech_id is shared by all accesses or given per access as a list
+    flex_node = create_flex_xml()
+    exchange_node = etree.SubElement(flex_node, "dataExchange")
+    request_node = etree.SubElement(exchange_node, "dataRequest")
+
+    if (not isinstance(mech_id, (list, tuple))):
+        mech_id = [mech_id] * len(accesses)
+    keys = []
+    for (group, request_id, subid_base), mech_id in zip(accesses, mech_id):
+        unit, mech_multiplier, count = set_request_properties(
+            group, request_id, subid_base, mech_id)
+        if (mech_multiplier < 0):
+            raise ValueError("invalid access {}:{}:{}".format(
+                group, request_id, subid_base))
+        subid = subid_base + (mech_id - 1) * mech_multiplier
+        request_node.append(
+            create_data_node(unit, group, request_id, subid, count, cycle,
+                             threshold))
+        keys.append("unit:{};group:{};id:{};subid:{};count:{};".format(
+            unit, group, request_id, subid, count))
+    return (keys, flex_node)
+
+
 def create_update_xml(group, request_id, subid_base, mech_id, data, seqid):
     unit, mech_multiplier, count = set_request_properties(
         group, request_id, subid_base, mech_id)
     if (mech_multiplier < 0):
-        print("invalid access")
+        logger.warning("invalid access")
         return ""
     subid = subid_base + (mech_id - 1) * mech_multiplier
 
@@ -220,223 +266,866 @@ def create_payload(element):
     return PACKET_MAGIC_NUMBER + xml_length + xml
 
 
+def template_field(name):
+    return "__{}__".format(name)
+
+
+class PayloadTemplate(object):
+    # serialised once with template_field() placeholders; render() only
+    # splices the changing fields into the cached bytes, escaped as lxml
+    # would so they are safe in text and in attribute values
+    def __init__(self, element, fields):
+        xml = convert_xml_to_binary_string(element)
+        pattern = b"|".join(
+            re.escape(template_field(field).encode()) for field in fields)
+        self.parts = re.split(b"(" + pattern + b")", xml)
+        self.fields = [part.decode()[2:-2] for part in self.parts[1::2]]
+        # a field right after an opening quote is an attribute value
+        self.entities = [{'"': "&quot;"} if part.endswith(b'="') else {}
+                         for part in self.parts[0:-1:2]]
+
+    def render(self, values):
+        pieces = list(self.parts)
+        pieces[1::2] = [
+            escape(str(values[field]), entities).encode()
+            for field, entities in zip(self.fields, self.entities)
+        ]
+        xml = b"".join(pieces)
+        return PACKET_MAGIC_NUMBER + struct.pack('<i', len(xml)) + xml
+
+
+@lru_cache(maxsize=256)
+def create_access_payload(group, request_id, subid_base, mech_id, cycle,
+                          threshold):
+    key, flex_node = create_access_xml(group, request_id, subid_base, mech_id,
+                                       cycle, threshold)
+    return key, create_payload(flex_node)
+
+
+@lru_cache(maxsize=256)
+def get_update_template(group, request_id, subid_base, mech_id):
+    _, flex_node = create_update_xml(group, request_id, subid_base, mech_id,
+                                     template_field("data"),
+                                     template_field("seqid"))
+    return PayloadTemplate(flex_node, ["seqid", "data"])
+
+
+def create_update_payload(group, request_id, subid_base, mech_id, data,
+                          seqid):
+    template = get_update_template(group, request_id, subid_base, mech_id)
+    return "seqid:{};".format(seqid), template.render({
+        "seqid": seqid,
+        "data": data
+    })
+
+
+@lru_cache(maxsize=256)
+def get_command_template(command_name, param_spec):
+    # param_spec is a tuple of (param_name, has_value)
+    flex_node = create_flex_xml()
+    operations_node = etree.SubElement(flex_node, "operations")
+    command_node = etree.SubElement(operations_node, "command")
+    command_node.set("sequid", template_field("sequid"))
+    command_node.set("name", command_name)
+    fields = ["sequid"]
+    for i, (param_name, has_value) in enumerate(param_spec):
+        param_node = etree.SubElement(command_node, "param", name=param_name)
+        if (has_value):
+            field = "p{}".format(i)
+            param_node.text = template_field(field)
+            fields.append(field)
+    return PayloadTemplate(flex_node, fields)
+
+
+class FrameDecoder(object):
+    def __init__(self, on_frame):
+        self.on_frame = on_frame
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        # frames may be split or coalesced arbitrarily by TCP, so keep the
+        # incomplete tail buffered until the rest of it arrives
+        self.buffer += data
+        start = 0
+        view = memoryview(self.buffer)
+        try:
+            while (len(view) - start >= FRAME_HEADER_SIZE):
+                if (view[start:start + 4] != PACKET_MAGIC_NUMBER):
+                    raise ValueError
+                xml_length = int.from_bytes(view[start + 4:start + 8],
+                                            byteorder='little')
+                end = start + FRAME_HEADER_SIZE + xml_length
+                if (end > len(view)):
+                    break
+                frame = view[start + FRAME_HEADER_SIZE:end]
+                start = end
+                try:
+                    self.on_frame(frame)
+                finally:
+                    frame.release()
+        finally:
+            view.release()
+            del self.buffer[:start]
+
+    def pending(self):
+        return len(self.buffer)
+
+
 def parse_xml_replies(raw_bytes):
-    chunk_start = 0
     elements = []
-    while (chunk_start < len(raw_bytes)):
-        if (raw_bytes[chunk_start:chunk_start + 4] != PACKET_MAGIC_NUMBER):
-            raise ValueError
-        xml_length = int.from_bytes(raw_bytes[chunk_start + 4:chunk_start + 8],
-                                    byteorder='little')
-        elements += [
-            etree.fromstring(raw_bytes[chunk_start + 8:chunk_start + 8 +
-                                       xml_length])
-        ]
-        chunk_start += xml_length + 8
+    decoder = FrameDecoder(lambda frame: elements.append(
+        etree.fromstring(frame)))
+    decoder.feed(raw_bytes)
+    if (decoder.pending() > 0):
+        raise ValueError
     return elements
 
 
-def get_access_xml_key(element):
-    data_node = element.xpath(
-        "/ns:flexData/ns:dataExchange/ns:dataUpdate/ns:data",
-        namespaces=FLEX_GUI_NAMESPACE)[0]
-    unit = data_node.get("unit")
-    group = data_node.get("group")
-    request_id = data_node.get("id")
-    subid = data_node.get("subid")
-    count = int(data_node.get("count"))
+def flex_tag(localname):
+    return "{{{}}}{}".format(FLEX_GUI_NAMESPACE['ns'], localname)
 
+
+DATA_EXCHANGE_TAG = flex_tag("dataExchange")
+DATA_UPDATE_TAG = flex_tag("dataUpdate")
+DATA_UPDATE_ACK_TAG = flex_tag("dataUpdateAck")
+DATA_TAG = flex_tag("data")
+OPERATIONS_TAG = flex_tag("operations")
+COMMAND_RESULT_TAG = flex_tag("commandResult")
+RESULT_TAG = flex_tag("result")
+RESULT_TEXT_TAG = flex_tag("resultText")
+NOTIFICATIONS_TAG = flex_tag("notifications")
+NOTE_TAG = flex_tag("note")
+VALUE_TAG_MAP = {
+    flex_tag(value_type.name): value_type
+    for value_type in (XMLValueType.r, XMLValueType.i, XMLValueType.b)
+}
+VALUE_CONVERTERS = {
+    XMLValueType.r: float,
+    XMLValueType.i: int,
+    XMLValueType.b: lambda text: int(text) != 0
+}
+NOTE_FIELD_CONVERTERS = {
+    flex_tag("unit"): ('unit', int),
+    flex_tag("mech"): ('mech_id', int),
+    flex_tag("axis"): ('axis', int),
+    flex_tag("line"): ('line', int),
+    flex_tag("code"): ('code', int),
+    flex_tag("program"): ('program', str),
+    flex_tag("message"): ('message', str),
+    flex_tag("content"): ('content', str),
+    flex_tag("measures"): ('measures', str)
+}
+
+DATA_UPDATE_XPATH = etree.XPath(
+    "/ns:flexData/ns:dataExchange/ns:dataUpdate/ns:data",
+    namespaces=FLEX_GUI_NAMESPACE)
+DATA_UPDATE_ACK_XPATH = etree.XPath(
+    "/ns:flexData/ns:dataExchange/ns:dataUpdateAck",
+    namespaces=FLEX_GUI_NAMESPACE)
+COMMAND_RESULT_XPATH = etree.XPath(
+    "/ns:flexData/ns:operations/ns:commandResult",
+    namespaces=FLEX_GUI_NAMESPACE)
+NOTE_XPATH = etree.XPath("/ns:flexData/ns:notifications/ns:note",
+                         namespaces=FLEX_GUI_NAMESPACE)
+
+Reply = namedtuple('Reply', ['kind', 'key', 'values'])
+
+
+def create_access_key(data_node):
     return "unit:{};group:{};id:{};subid:{};count:{};".format(
-        unit, group, request_id, subid, count), data_node
+        data_node.get("unit"), data_node.get("group"), data_node.get("id"),
+        data_node.get("subid"), int(data_node.get("count")))
+
+
+def create_command_result_key(command_result_node):
+    return "command_name:{};sequid:{};".format(
+        command_result_node.get("name"),
+        int(command_result_node.get("sequid")))
+
+
+def get_access_xml_key(element):
+    data_node = DATA_UPDATE_XPATH(element)[0]
+    return create_access_key(data_node), data_node
 
 
 def get_update_ack_xml_key(element):
-    data_ack_node = element.xpath(
-        "/ns:flexData/ns:dataExchange/ns:dataUpdateAck",
-        namespaces=FLEX_GUI_NAMESPACE)[0]
+    data_ack_node = DATA_UPDATE_ACK_XPATH(element)[0]
     seqid = int(data_ack_node.get("seqid"))
     return "seqid:{};".format(seqid)
 
 
 def get_command_result_xml_key(element):
-    command_result_node = element.xpath(
-        "/ns:flexData/ns:operations/ns:commandResult",
-        namespaces=FLEX_GUI_NAMESPACE)[0]
-    command_name = command_result_node.get("name")
-    sequid = int(command_result_node.get("sequid"))
-    return "command_name:{};sequid:{};".format(command_name, sequid)
+    return create_command_result_key(COMMAND_RESULT_XPATH(element)[0])
 
 
 def get_value_type(data_node):
-    tagname = etree.QName(data_node[0]).localname
-    if (tagname == XMLValueType.r.name):
-        return XMLValueType.r
-    if (tagname == XMLValueType.i.name):
-        return XMLValueType.i
-    if (tagname == XMLValueType.b.name):
-        return XMLValueType.b
-    return XMLValueType.unknown
+    return VALUE_TAG_MAP.get(data_node[0].tag, XMLValueType.unknown)
 
 
 def get_reply_type(element):
-    if len(
-            element.xpath("/ns:flexData/ns:dataExchange/ns:dataUpdate/ns:data",
-                          namespaces=FLEX_GUI_NAMESPACE)) > 0:
+    if len(DATA_UPDATE_XPATH(element)) > 0:
         return XMLReplyType.data_update
-    if len(
-            element.xpath("/ns:flexData/ns:dataExchange/ns:dataUpdateAck",
-                          namespaces=FLEX_GUI_NAMESPACE)) > 0:
+    if len(DATA_UPDATE_ACK_XPATH(element)) > 0:
         return XMLReplyType.data_update_ack
-    if len(
-            element.xpath("/ns:flexData/ns:operations/ns:commandResult",
-                          namespaces=FLEX_GUI_NAMESPACE)) > 0:
+    if len(COMMAND_RESULT_XPATH(element)) > 0:
         return XMLReplyType.command_result
-    if len(
-            element.xpath("/ns:flexData/ns:notifications/ns:note",
-                          namespaces=FLEX_GUI_NAMESPACE)) > 0:
+    if len(NOTE_XPATH(element)) > 0:
         return XMLReplyType.notification
     return XMLReplyType.unknown_reply
 
 
 def parse_xml_value(data_node):
     value_type = get_value_type(data_node)
-    strings = np.array(
-        data_node.xpath("//ns:data/ns:{}/text()".format(value_type.name),
-                        namespaces=FLEX_GUI_NAMESPACE))
-    converted = strings.astype(get_numpy_type(value_type))
-    return converted[0] if len(converted) == 1 else converted
+    convert = VALUE_CONVERTERS.get(value_type)
+    converted = np.empty(len(data_node), dtype=get_numpy_type(value_type))
+    count = 0
+    value_tag = data_node[0].tag
+    for value_node in data_node:
+        if (value_node.tag == value_tag):
+            converted[count] = convert(value_node.text)
+            count += 1
+    return converted[0] if count == 1 else converted[:count]
+
+
+def parse_command_result_node(command_result_node):
+    result = None
+    result_text = None
+    for node in command_result_node:
+        if (node.tag == RESULT_TAG):
+            result = int(node.text)
+        elif (node.tag == RESULT_TEXT_TAG):
+            result_text = node.text
+    return result, result_text
 
 
 def parse_xml_command_result(element):
-    result_node = element.xpath(
-        "/ns:flexData/ns:operations/ns:commandResult/ns:result",
-        namespaces=FLEX_GUI_NAMESPACE)[0]
-    result = int(result_node.text)
-    result_text = element.xpath(
-        "/ns:flexData/ns:operations/ns:commandResult/ns:resultText",
-        namespaces=FLEX_GUI_NAMESPACE)[0].text
-    return result, result_text
+    return parse_command_result_node(COMMAND_RESULT_XPATH(element)[0])
+
+
+def parse_note_node(note_node):
+    note = {name: None for (name, _) in NOTE_FIELD_CONVERTERS.values()}
+    for node in note_node:
+        if (node.tag in NOTE_FIELD_CONVERTERS and node.text is not None):
+            name, convert = NOTE_FIELD_CONVERTERS[node.tag]
+            note[name] = convert(node.text)
+    return note
 
 
 def parse_xml_notification(element):
-    code_node = element.xpath("/ns:flexData/ns:notifications/ns:note/ns:code",
-                              namespaces=FLEX_GUI_NAMESPACE)[0]
-    code = int(code_node.text)
-
-    mech_nodes = element.xpath("/ns:flexData/ns:notifications/ns:note/ns:mech",
-                               namespaces=FLEX_GUI_NAMESPACE)
-    if (len(mech_nodes) > 0):
-        mech_id = int(mech_nodes[0].text)
-
-    axis_nodes = element.xpath("/ns:flexData/ns:notifications/ns:note/ns:axis",
-                               namespaces=FLEX_GUI_NAMESPACE)
-    if (len(axis_nodes) > 0):
-        axis = int(axis_nodes[0].text)
-
-    line_nodes = element.xpath("/ns:flexData/ns:notifications/ns:note/ns:line",
-                               namespaces=FLEX_GUI_NAMESPACE)
-    if (len(line_nodes) > 0):
-        line = int(line_nodes[0].text)
-
-    program_nodes = element.xpath(
-        "/ns:flexData/ns:notifications/ns:note/ns:program",
-        namespaces=FLEX_GUI_NAMESPACE)
-    if (len(program_nodes) > 0):
-        program = program_nodes[0].text
-
-    message = element.xpath("/ns:flexData/ns:notifications/ns:note/ns:message",
-                            namespaces=FLEX_GUI_NAMESPACE)[0].text
-
-    content = element.xpath("/ns:flexData/ns:notifications/ns:note/ns:content",
-                            namespaces=FLEX_GUI_NAMESPACE)[0].text
-    measures = element.xpath(
-        "/ns:flexData/ns:notifications/ns:note/ns:measures",
-        namespaces=FLEX_GUI_NAMESPACE)[0].text
-    return {
-        'unit': unit,
-        'mech_id': mech_id,
-        'axis': axis,
-        'line': line,
-        'program': program,
-        'message': message,
-        'content': content,
-        'measures': measures
-    }
+    return parse_note_node(NOTE_XPATH(element)[0])
+
+
+def decode_replies(element):
+    # walk the children of the root once instead of running one absolute
+    # xpath query per reply type; a batched request is answered with one
+    # data node per requested variable
+    for section in element:
+        if (section.tag == DATA_EXCHANGE_TAG):
+            replies = []
+            for node in section:
+                if (node.tag == DATA_UPDATE_TAG):
+                    for data_node in node.iterchildren(DATA_TAG):
+                        replies.append(
+                            Reply(XMLReplyType.data_update,
+                                  create_access_key(data_node),
+                                  parse_xml_value(data_node)))
+                elif (node.tag == DATA_UPDATE_ACK_TAG):
+                    replies.append(
+                        Reply(XMLReplyType.data_update_ack,
+                              "seqid:{};".format(int(node.get("seqid"))),
+                              None))
+            if (len(replies) > 0):
+                return replies
+        elif (section.tag == OPERATIONS_TAG):
+            node = section.find(COMMAND_RESULT_TAG)
+            if (node is not None):
+                return [
+                    Reply(XMLReplyType.command_result,
+                          create_command_result_key(node),
+                          parse_command_result_node(node))
+                ]
+        elif (section.tag == NOTIFICATIONS_TAG):
+            node = section.find(NOTE_TAG)
+            if (node is not None):
+                return [
+                    Reply(XMLReplyType.notification, None,
+                          parse_note_node(node))
+                ]
+    return [Reply(XMLReplyType.unknown_reply, None, None)]
+
+
+def decode_reply(element):
+    return decode_replies(element)[0]
+
+
+# the dataUpdate document echoed back for requests built by create_access_xml;
+# anything that does not match this exact shape goes through lxml instead
+DATA_UPDATE_PATTERN = re.compile(
+    rb'(?:<\?xml[^>]*\?>)?\s*<flexData[^>]*>\s*<dataExchange>\s*'
+    rb'<dataUpdate[^>]*>\s*'
+    rb'<data unit="([^"&]*)" group="([^"&]*)" id="([^"&]*)" '
+    rb'subid="([^"&]*)" count="(\d+)"[^>]*>'
+    rb'((?:\s*<r>[^<]*</r>)+)\s*'
+    rb'</data>\s*</dataUpdate>\s*</dataExchange>\s*</flexData>\s*')
+R_VALUE_PATTERN = re.compile(rb'<r>([^<]*)</r>')
+DATA_KEY_PATTERN = re.compile(
+    rb'<data unit="([^"&]*)" group="([^"&]*)" id="([^"&]*)" '
+    rb'subid="([^"&]*)" count="(\d+)"')
+
+
+def find_data_keys(frame):
+    # keys of the data nodes in a frame without parsing their values; empty
+    # when the frame holds none or uses another attribute layout
+    return [
+        "unit:{};group:{};id:{};subid:{};count:{};".format(
+            unit.decode(), group.decode(), request_id.decode(),
+            subid.decode(), int(count))
+        for unit, group, request_id, subid, count in
+        DATA_KEY_PATTERN.findall(frame)
+    ]
+
+
+def decode_data_update_fast(frame):
+    match = DATA_UPDATE_PATTERN.fullmatch(frame)
+    if (match is None):
+        return None
+    unit, group, request_id, subid, count, body = match.groups()
+    texts = R_VALUE_PATTERN.findall(body)
+    if (len(texts) != int(count)):
+        return None
+    values = np.empty(len(texts), dtype=np.float32)
+    for i, text in enumerate(texts):
+        values[i] = float(text)
+    key = "unit:{};group:{};id:{};subid:{};count:{};".format(
+        unit.decode(), group.decode(), request_id.decode(), subid.decode(),
+        int(count))
+    return Reply(XMLReplyType.data_update, key,
+                 values[0] if len(values) == 1 else values)
+
+
+def decode_frame(frame, fast_decode=False):
+    if (fast_decode):
+        reply = decode_data_update_fast(frame)
+        if (reply is not None):
+            return [reply]
+    return decode_replies(etree.fromstring(frame))
+
+
+def decode_frames(frames, fast_decode=False):
+    # runs in an executor, so each frame's parse time is measured here and
+    # returned with its replies
+    results = []
+    for frame in frames:
+        start = time.perf_counter()
+        replies = decode_frame(frame, fast_decode)
+        results.append((replies, time.perf_counter() - start))
+    return results
+
+
+class DecoderQueue(object):
+    # decodes batches of frames in an executor and hands their replies back on
+    # the loop in arrival order. When max_pending batches are in flight the
+    # oldest is dropped if drop_oldest is set, otherwise reading is paused so
+    # that nothing is lost
+    def __init__(self,
+                 executor,
+                 deliver,
+                 fast_decode=False,
+                 max_pending=64,
+                 drop_oldest=False,
+                 stats=None):
+        self.executor = executor
+        self.deliver = deliver
+        self.stats = stats
+        self.fast_decode = fast_decode
+        self.max_pending = max_pending
+        self.drop_oldest = drop_oldest
+        self.pending = deque()
+        self.dropped = 0
+        self.transport = None
+        self.paused = False
+
+    def submit(self, frames, arrival=None):
+        if (len(self.pending) >= self.max_pending):
+            if (self.drop_oldest):
+                self.drop()
+            elif (not self.paused and self.transport is not None):
+                self.transport.pause_reading()
+                self.paused = True
+        job = self.executor.submit(decode_frames, frames, self.fast_decode)
+        fut = asyncio.wrap_future(job)
+        fut.add_done_callback(self.drain)
+        self.pending.append((fut, job, len(frames), arrival))
+
+    def drop(self):
+        # batches a worker has already started are left to finish, so a slow
+        # pool still delivers something instead of discarding its own work
+        for i, (fut, job, count, _) in enumerate(self.pending):
+            if (job.cancel()):
+                del self.pending[i]
+                fut.cancel()
+                self.dropped += count
+                return
+
+    def drain(self, _=None):
+        while (self.pending and self.pending[0][0].done()):
+            fut, _, _, arrival = self.pending.popleft()
+            if (fut.cancelled()):
+                continue
+            if (fut.exception() is not None):
+                logger.error('decoding failed: %r', fut.exception())
+                continue
+            for replies, elapsed in fut.result():
+                if (self.stats is not None):
+                    self.stats.parse_time.record(elapsed)
+                self.deliver(replies, arrival)
+        if (self.paused and len(self.pending) < self.max_pending):
+            self.paused = False
+            if (not self.transport.is_closing()):
+                self.transport.resume_reading()
+
+
+def create_move_params(v, command_name, move_type):
+    params = []
+    if (command_name == "MoveXR" or command_name == "MoveX"):
+        params.append(('X', v[0]))
+        params.append(('Y', v[1]))
+        params.append(('Z', v[2]))
+        params.append(('r', v[3]))
+        params.append(('p', v[4]))
+        params.append(('y', v[5]))
+        params.append(('conf', 0))
+    else:
+        params.append(('angle1', v[0]))
+        params.append(('angle2', v[1]))
+        params.append(('angle3', v[2]))
+        params.append(('angle4', v[3]))
+        params.append(('angle5', v[4]))
+        params.append(('angle6', v[5]))
+    if (move_type != MoveType.thru):
+        params.append(
+            ("PAUSE" if move_type == MoveType.positioning else "END", None))
+    return params
 
 
 class ClientProtocol(asyncio.Protocol):
-    def __init__(self, pull_map):
+    channel = CONTROL
+
+    def __init__(self,
+                 pull_map,
+                 fast_decode=False,
+                 stats=None,
+                 capture=None,
+                 executor=None,
+                 max_pending=64):
         self.pull_map = pull_map
+        self.fast_decode = fast_decode
+        self.stats = stats
+        self.capture = capture
+        self.decoder = FrameDecoder(self.dispatch)
+        self.frames = []
+        # command results are never dropped; reading pauses instead
+        self.decoder_queue = None if executor is None else DecoderQueue(
+            executor, self.deliver, fast_decode, max_pending, stats=stats)
 
     def connection_made(self, transport):
-        print('connection made')
+        logger.info('connection made')
+        if (self.decoder_queue is not None):
+            self.decoder_queue.transport = transport
 
     def data_received(self, data):
-        print("data received")
-        elements = parse_xml_replies(data)
-        for element in elements:
-            reply_type = get_reply_type(element)
-            if reply_type == XMLReplyType.data_update:
-                key, data_node = get_access_xml_key(element)
-                fut = self.pull_map[key].get()
-                fut.set_result(parse_xml_value(data_node))
-            elif reply_type == XMLReplyType.data_update_ack:
-                key = get_update_ack_xml_key(element)
-                fut = self.pull_map[key].get()
-                fut.set_result(None)
-            elif reply_type == XMLReplyType.command_result:
-                print('command result received')
-                key = get_command_result_xml_key(element)
-                print('key = ' + key)
-                fut = self.pull_map[key].get()
-                result, result_text = parse_xml_command_result(element)
+        logger.debug("data received")
+        if (self.stats is not None):
+            self.stats.bytes_in += len(data)
+        if (self.capture is not None):
+            self.capture.record(self.channel, INBOUND, data)
+        self.decoder.feed(data)
+        if (self.frames):
+            self.decoder_queue.submit(self.frames)
+            self.frames = []
+
+    def dispatch(self, frame):
+        if (self.decoder_queue is not None):
+            # the frame view is released once this returns
+            self.frames.append(bytes(frame))
+            if (self.stats is not None):
+                self.stats.frames_in += 1
+            return
+        if (self.stats is None):
+            replies = decode_frame(frame, self.fast_decode)
+        else:
+            start = time.perf_counter()
+            replies = decode_frame(frame, self.fast_decode)
+            self.stats.parse_time.record(time.perf_counter() - start)
+            self.stats.frames_in += 1
+        self.deliver(replies)
+
+    def deliver(self, replies, arrival=None):
+        for reply in replies:
+            if reply.kind == XMLReplyType.data_update:
+                fut = self.pop_future(reply.key)
+                if (fut is not None):
+                    fut.set_result(reply.values)
+            elif reply.kind == XMLReplyType.data_update_ack:
+                fut = self.pop_future(reply.key)
+                if (fut is not None):
+                    fut.set_result(None)
+            elif reply.kind == XMLReplyType.command_result:
+                logger.debug('command result received, key = %s',
+                             reply.key)
+                fut = self.pop_future(reply.key)
+                if (fut is None):
+                    continue
+                result, result_text = reply.values
                 if result == 1:
                     fut.set_result((result, result_text))
                 else:
                     fut.set_exception(RuntimeError)
-            elif reply_type == XMLReplyType.notification:
-                print(parse_xml_notification(element))
+            elif reply.kind == XMLReplyType.notification:
+                logger.info('notification: %s', reply.values)
+
+    def pop_future(self, key):
+        # replies to one key arrive in request order, so the oldest slot owns
+        # the reply. A request that timed out leaves a drain deadline in its
+        # slot; its late reply lands there and is dropped instead of
+        # resolving the next request for the key. Past the deadline the
+        # reply is taken as lost and the slot is skipped
+        futs = self.pull_map.get(key)
+        now = time.monotonic()
+        while futs:
+            slot = futs.popleft()
+            if (len(futs) == 0):
+                del self.pull_map[key]
+            if (isinstance(slot, float)):
+                if (slot >= now):
+                    break
+            elif (not slot.done()):
+                return slot
+        if (self.stats is not None):
+            self.stats.orphaned_replies += 1
+        return None
 
     def connection_lost(self, exc):
-        print('Connection lost')
+        logger.info('Connection lost')
+        for futs in self.pull_map.values():
+            for fut in futs:
+                if (not isinstance(fut, float) and not fut.done()):
+                    fut.set_exception(ConnectionError())
+        self.pull_map.clear()
 
 
 class Controller(object):
     @classmethod
-    async def create(cls, ip, port=9876):
+    async def create(cls,
+                     ip,
+                     port=9876,
+                     fast_decode=True,
+                     max_in_flight=64,
+                     stats=False,
+                     capture=None,
+                     executor=None,
+                     max_pending=64,
+                     drain=5.0,
+                     monitor_idle_timeout=None):
+        # capture is a path that receives every raw chunk sent or received;
+        # executor is a thread or process pool that decodes frames off the
+        # loop, with at most max_pending batches in flight per connection;
+        # a request that timed out holds its reply slot for drain seconds.
+        # With monitor_idle_timeout the monitor connection is closed once it
+        # has had no subscriber for that many seconds
         self = cls()
         self.pull_map = {}
+        self.drain = drain
+        self.behind_drain = set()
+        # instrumentation is opt-in so the hot paths only pay a None check
+        self.statistics = ConnectionStats() if stats else None
+        self.exporter = None
+        self.write_buffer = []
+        self.max_in_flight = max_in_flight
+        self.in_flight = asyncio.Semaphore(max_in_flight)
         loop = asyncio.get_running_loop()
         self.ip = ip
         self.port = port
+        self.fast_decode = fast_decode
+        self.executor = executor
+        self.max_pending = max_pending
+        self.monitor_idle_timeout = monitor_idle_timeout
         self.sequid = 0
         self.seqid = 0
+        self.monitor_controller = None
+        self.monitor_lock = asyncio.Lock()
+        # key -> (value, time.monotonic()) of the last pulled or pushed value
+        self.state_cache = {}
+        self.cache_subscriptions = {}
+        self.notify_groups = {}
+        self.capture = None if capture is None else CaptureWriter(capture)
         self.transport, self.protocol = await loop.create_connection(
-            lambda: ClientProtocol(self.pull_map), ip, port)
+            lambda: ClientProtocol(self.pull_map, fast_decode, self.statistics,
+                                   self.capture, executor, max_pending), ip,
+            port)
         return self
 
     def close(self):
+        if self.exporter is not None:
+            self.exporter.cancel()
+            self.exporter = None
+        if self.monitor_controller is not None:
+            self.monitor_controller.close()
+        self.cache_subscriptions.clear()
+        for notify_group in self.notify_groups.values():
+            notify_group.fail(ConnectionError())
         if not self.transport.is_closing():
-            print("close transport")
+            logger.debug("close transport")
             self.transport.close()
+        self.stop_capture()
+
+    def start_capture(self, path):
+        self.stop_capture()
+        self.capture = CaptureWriter(path)
+        self.protocol.capture = self.capture
+        if (self.monitor_controller is not None):
+            self.monitor_controller.protocol.capture = self.capture
+        return self.capture
+
+    def stop_capture(self):
+        if (self.capture is None):
+            return
+        self.protocol.capture = None
+        if (self.monitor_controller is not None):
+            self.monitor_controller.protocol.capture = None
+        self.capture.close()
+        self.capture = None
+
+    def stats(self):
+        if (self.statistics is None):
+            return None
+        snapshot = {"control": self.statistics.snapshot()}
+        if (self.monitor_controller is not None
+                and self.monitor_controller.statistics is not None):
+            snapshot["monitor"] = self.monitor_controller.statistics.snapshot()
+        return snapshot
+
+    @property
+    def arrival(self):
+        # time.monotonic() at which the sample being passed to a monitor
+        # callback was received
+        if (self.monitor_controller is None):
+            return None
+        return self.monitor_controller.arrival
+
+    def export_stats(self, exporter, interval=1.0):
+        # calls exporter(snapshot) every interval seconds until close()
+        async def export():
+            while True:
+                await asyncio.sleep(interval)
+                exporter(self.stats())
+
+        if (self.exporter is not None):
+            self.exporter.cancel()
+        self.exporter = asyncio.ensure_future(export())
+        return self.exporter
+
+    async def get_monitor_controller(self):
+        # every subscription shares one long-lived monitor connection, which
+        # is only reopened if the controller dropped it
+        async with self.monitor_lock:
+            if (self.monitor_controller is None
+                    or self.monitor_controller.transport.is_closing()):
+                self.monitor_controller = await MonitorController.create(
+                    self.ip,
+                    self.port,
+                    fast_decode=self.fast_decode,
+                    stats=self.statistics is not None,
+                    capture=self.capture,
+                    executor=self.executor,
+                    max_pending=self.max_pending,
+                    idle_timeout=self.monitor_idle_timeout)
+            return self.monitor_controller
 
     def add_future_to_pull_map(self, key):
         loop = asyncio.get_running_loop()
         if key not in self.pull_map:
-            self.pull_map[key] = queue.Queue()
+            self.pull_map[key] = deque()
+        futs = self.pull_map[key]
+        # drain slots whose reply is overdue are taken as lost
+        now = time.monotonic()
+        while (futs and isinstance(futs[0], float) and futs[0] < now):
+            futs.popleft()
         fut = loop.create_future()
-        self.pull_map[key].put(fut)
+        # if the reply of an earlier request was lost, the drain slot ahead
+        # absorbs the reply of this one, which must then not leave a slot of
+        # its own or every later request would time out in turn
+        if (any(isinstance(slot, float) for slot in futs)):
+            self.behind_drain.add(fut)
+        futs.append(fut)
         return fut
 
+    def abandon_future(self, key, fut):
+        # the request was sent, so its slot is kept for up to self.drain
+        # seconds to absorb the late reply
+        behind_drain = fut in self.behind_drain
+        self.behind_drain.discard(fut)
+        futs = self.pull_map.get(key)
+        if (futs is None or fut not in futs):
+            return
+        if (behind_drain):
+            futs.remove(fut)
+            if (len(futs) == 0):
+                del self.pull_map[key]
+        else:
+            futs[futs.index(fut)] = time.monotonic() + self.drain
+
+    def send(self, payload):
+        # payloads queued in the same loop iteration go out in one write
+        if (len(self.write_buffer) == 0):
+            asyncio.get_running_loop().call_soon(self.flush)
+        self.write_buffer.append(payload)
+
+    def flush(self):
+        if (not self.transport.is_closing()):
+            data = b"".join(self.write_buffer)
+            self.transport.write(data)
+            if (self.statistics is not None):
+                self.statistics.bytes_out += len(data)
+                self.statistics.frames_out += len(self.write_buffer)
+            if (self.capture is not None):
+                self.capture.record(CONTROL, OUTBOUND, data)
+        self.write_buffer.clear()
+
+    def post_payload(self, keys, payload):
+        futs = [self.add_future_to_pull_map(key) for key in keys]
+        self.send(payload)
+        return futs
+
+    async def wait_replies(self, keys, futs, timeout, sent=None):
+        try:
+            if (len(futs) == 1):
+                replies = [await asyncio.wait_for(futs[0], timeout=timeout)]
+            else:
+                replies = await asyncio.wait_for(asyncio.gather(*futs),
+                                                 timeout=timeout)
+            if (self.statistics is not None and sent is not None):
+                elapsed = time.perf_counter() - sent
+                for key in keys:
+                    self.statistics.record_round_trip(key, elapsed)
+            return replies
+        except asyncio.TimeoutError:
+            if (self.statistics is not None):
+                self.statistics.timeouts += 1
+            raise
+        finally:
+            for key, fut in zip(keys, futs):
+                if (not fut.done() or fut.cancelled()):
+                    self.abandon_future(key, fut)
+                else:
+                    self.behind_drain.discard(fut)
+
+    async def send_payload_and_wait_replies(self, keys, payload, timeout):
+        # timeout covers the wait for an in-flight slot as well as the reply
+        deadline = time.monotonic() + timeout
+        try:
+            await asyncio.wait_for(self.in_flight.acquire(), timeout=timeout)
+        except asyncio.TimeoutError:
+            if (self.statistics is not None):
+                self.statistics.timeouts += 1
+            raise
+        try:
+            sent = time.perf_counter()
+            futs = self.post_payload(keys, payload)
+            return await self.wait_replies(keys, futs,
+                                           deadline - time.monotonic(), sent)
+        finally:
+            self.in_flight.release()
+
+    async def send_payload_and_wait_reply(self, key, payload, timeout):
+        return (await self.send_payload_and_wait_replies([key], payload,
+                                                         timeout))[0]
+
+    async def send_and_wait_replies(self, keys, flex_node, timeout):
+        return await self.send_payload_and_wait_replies(
+            keys, create_payload(flex_node), timeout)
+
     async def send_and_wait_reply(self, key, flex_node, timeout):
-        fut = self.add_future_to_pull_map(key)
-        self.transport.write(create_payload(flex_node))
-        return await asyncio.wait_for(fut, timeout=timeout)
+        return await self.send_payload_and_wait_reply(
+            key, create_payload(flex_node), timeout)
 
-    async def access(self, group, request_id, subid, mech_id=1, timeout=5.0):
-        key, flex_node = create_access_xml(group, request_id, subid, mech_id,
-                                           MonitorCycle.pull, 0.01)
-        return await self.send_and_wait_reply(key, flex_node, timeout)
+    async def access(self,
+                     group,
+                     request_id,
+                     subid,
+                     mech_id=1,
+                     timeout=5.0,
+                     max_age=None):
+        # with max_age a value seen within the last max_age seconds is served
+        # from the state cache instead of being pulled
+        key, payload = create_access_payload(group, request_id, subid,
+                                             mech_id, MonitorCycle.pull, 0.01)
+        if (max_age is not None):
+            entry = self.state_cache.get(key)
+            if (entry is not None
+                    and time.monotonic() - entry[1] <= max_age):
+                return entry[0]
+        value = await self.send_payload_and_wait_reply(key, payload, timeout)
+        self.cache_value(key, value)
+        return value
+
+    async def access_many(self, names, mech_id=1, timeout=5.0):
+        # read several ACCESS_CODE_MAP variables with a single dataRequest
+        names = list(dict.fromkeys(names))
+        values = await self.access_batch([(name, mech_id) for name in names],
+                                         timeout)
+        return dict(zip(names, values))
+
+    async def access_batch(self, items, timeout=5.0):
+        # (name, mech_id) pairs, possibly for different mechanisms, read with
+        # a single dataRequest; values come back in the same order
+        keys, flex_node = create_access_many_xml(
+            [ACCESS_CODE_MAP[name] for name, _ in items],
+            [mech_id for _, mech_id in items], MonitorCycle.pull, 0.01)
+        values = await self.send_and_wait_replies(keys, flex_node, timeout)
+        for key, value in zip(keys, values):
+            self.cache_value(key, value)
+        return values
+
+    def cache_key(self, name, mech_id=1):
+        return create_access_payload(*ACCESS_CODE_MAP[name], mech_id,
+                                     MonitorCycle.pull, 0.01)[0]
+
+    def cache_value(self, key, value):
+        self.state_cache[key] = (value, time.monotonic())
+
+    async def enable_state_cache(self,
+                                 names,
+                                 mech_id=1,
+                                 cycle=MonitorCycle.at5ms,
+                                 threshold=MIN_THRESHOLD,
+                                 timeout=5.0):
+        # keeps a push subscription alive per variable so get_*(max_age=...)
+        # can be answered locally; a value inside the threshold is not
+        # pushed, so a quiet variable still goes stale and is pulled again
+        names = list(dict.fromkeys(names))
+        for name in names:
+            key = self.cache_key(name, mech_id)
+            subscription = self.cache_subscriptions.get(key)
+            if (subscription is not None and subscription.active):
+                continue
+            self.cache_subscriptions[key] = await self.monitor(
+                *ACCESS_CODE_MAP[name],
+                lambda values, key=key: self.cache_value(key, values),
+                mech_id, cycle, threshold)
+        # seed the cache since unchanged values are never pushed
+        return await self.access_many(names, mech_id, timeout)
+
+    def disable_state_cache(self, names=None, mech_id=1):
+        if (names is None):
+            keys = list(self.cache_subscriptions)
+        else:
+            keys = [self.cache_key(name, mech_id) for name in names]
+        for key in keys:
+            subscription = self.cache_subscriptions.pop(key, None)
+            if (subscription is not None):
+                subscription.close()
+            self.state_cache.pop(key, None)
 
     async def write(self,
                     group,
@@ -445,80 +1134,107 @@ class Controller(object):
                     data,
                     mech_id=1,
                     timeout=5.0):
-        key, flex_node = create_update_xml(group, request_id, subid, mech_id,
-                                           data, self.seqid)
-        return await self.send_and_wait_reply(key, flex_node, timeout)
+        key, payload = create_update_payload(group, request_id, subid,
+                                             mech_id, data, self.seqid)
+        self.seqid += 1
+        return await self.send_payload_and_wait_reply(key, payload, timeout)
 
-    async def get_position(self, mech_id=1, timeout=5.0):
+    async def get_position(self, mech_id=1, timeout=5.0, max_age=None):
         return await self.access(*ACCESS_CODE_MAP["AcsToolTipPos"],
                                  mech_id,
-                                 timeout=timeout)
+                                 timeout=timeout,
+                                 max_age=max_age)
 
-    async def get_velocity(self, mech_id=1, timeout=5.0):
+    async def get_velocity(self, mech_id=1, timeout=5.0, max_age=None):
         return await self.access(*ACCESS_CODE_MAP["AcsTcpSpeed"],
                                  mech_id,
-                                 timeout=timeout)
+                                 timeout=timeout,
+                                 max_age=max_age)
 
-    async def get_joint_angle_encoded(self, mech_id=1, timeout=5.0):
+    async def get_joint_angle_encoded(self,
+                                      mech_id=1,
+                                      timeout=5.0,
+                                      max_age=None):
         return await self.access(*ACCESS_CODE_MAP["AcsAxisEncode"],
                                  mech_id,
-                                 timeout=timeout)
+                                 timeout=timeout,
+                                 max_age=max_age)
 
-    async def get_joint_angle(self, mech_id=1, timeout=5.0):
+    async def get_joint_angle(self, mech_id=1, timeout=5.0, max_age=None):
         return await self.access(*ACCESS_CODE_MAP["AcsAxisTheta"],
                                  mech_id,
-                                 timeout=timeout)
+                                 timeout=timeout,
+                                 max_age=max_age)
 
-    async def get_joint_velocity(self, mech_id=1, timeout=5.0):
+    async def get_joint_velocity(self, mech_id=1, timeout=5.0, max_age=None):
         return await self.access(*ACCESS_CODE_MAP["AcsAxisSpeed"],
                                  mech_id,
-                                 timeout=timeout)
+                                 timeout=timeout,
+                                 max_age=max_age)
 
-    async def get_joint_target_velocity(self, mech_id=1, timeout=5.0):
+    async def get_joint_target_velocity(self,
+                                        mech_id=1,
+                                        timeout=5.0,
+                                        max_age=None):
         return await self.access(*ACCESS_CODE_MAP["AcsAxisOrderSpeed"],
                                  mech_id,
-                                 timeout=timeout)
+                                 timeout=timeout,
+                                 max_age=max_age)
 
-    async def get_playback_mode(self, mech_id=1, timeout=5.0):
+    async def get_playback_mode(self, mech_id=1, timeout=5.0, max_age=None):
         return await self.access(*ACCESS_CODE_MAP["AcsFixedIOPlayback"],
                                  mech_id,
-                                 timeout=timeout)
+                                 timeout=timeout,
+                                 max_age=max_age)
 
-    async def get_motor_power_on(self, mech_id=1, timeout=5.0):
+    async def get_motor_power_on(self, mech_id=1, timeout=5.0, max_age=None):
         return await self.access(*ACCESS_CODE_MAP["AcsServoMotorOnOff"],
                                  mech_id,
-                                 timeout=timeout)
+                                 timeout=timeout,
+                                 max_age=max_age)
 
-    async def get_motor_ready(self, mech_id=1, timeout=5.0):
+    async def get_motor_ready(self, mech_id=1, timeout=5.0, max_age=None):
         return await self.access(*ACCESS_CODE_MAP["AcsFixedIOConfirmMotorsOn"],
                                  mech_id,
-                                 timeout=timeout)
+                                 timeout=timeout,
+                                 max_age=max_age)
 
-    async def get_motor_launched(self, mech_id=1, timeout=5.0):
+    async def get_motor_launched(self, mech_id=1, timeout=5.0, max_age=None):
         return await self.access(*ACCESS_CODE_MAP["AcsFixedIOStartDisplay1"],
                                  mech_id,
-                                 timeout=timeout)
+                                 timeout=timeout,
+                                 max_age=max_age)
 
-    async def get_motor_lamp(self, mech_id=1, timeout=5.0):
+    async def get_motor_lamp(self, mech_id=1, timeout=5.0, max_age=None):
         return await self.access(*ACCESS_CODE_MAP["AcsFixedIOMotorsOnLAMP"],
                                  mech_id,
-                                 timeout=timeout)
+                                 timeout=timeout,
+                                 max_age=max_age)
 
-    async def get_energy_saving(self, mech_id=1, timeout=5.0):
+    async def get_energy_saving(self, mech_id=1, timeout=5.0, max_age=None):
         return await self.access(*ACCESS_CODE_MAP["AcsStatusSavingEnergy"],
                                  mech_id,
-                                 timeout=timeout)
+                                 timeout=timeout,
+                                 max_age=max_age)
 
-    async def get_joint_quadrature_current(self, mech_id=1, timeout=5.0):
+    async def get_joint_quadrature_current(self,
+                                           mech_id=1,
+                                           timeout=5.0,
+                                           max_age=None):
         return await self.access(*ACCESS_CODE_MAP["AcsAxisAmpValue"],
                                  mech_id,
-                                 timeout=timeout)
+                                 timeout=timeout,
+                                 max_age=max_age)
 
-    async def get_interpolation_type(self, mech_id=1, timeout=5.0):
+    async def get_interpolation_type(self,
+                                     mech_id=1,
+                                     timeout=5.0,
+                                     max_age=None):
         return InterpolationType(
             await self.access(*ACCESS_CODE_MAP["AcsInterpolationKind"],
                               mech_id,
-                              timeout=timeout))
+                              timeout=timeout,
+                              max_age=max_age))
 
     async def set_interpolation_type(self,
                                      interpolation_type,
@@ -529,13 +1245,22 @@ class Controller(object):
                                 mech_id,
                                 timeout=timeout)
 
-    async def monitor(self, group, request_id, subid, callback, mech_id, cycle,
-                      threshold):
-        print("in monitor, subid = {}".format(subid))
+    async def monitor(self,
+                      group,
+                      request_id,
+                      subid,
+                      callback,
+                      mech_id,
+                      cycle,
+                      threshold,
+                      stages=None):
+        # stages from fulcrane.stages run on each sample before the callback
+        logger.debug("in monitor, subid = %s", subid)
         key, flex_node = create_access_xml(group, request_id, subid, mech_id,
                                            cycle, threshold)
-        return await MonitorController.create(self.ip, self.port, key,
-                                              flex_node, callback)
+        monitor_controller = await self.get_monitor_controller()
+        return monitor_controller.subscribe(key, flex_node, callback,
+                                            CYCLE_PERIODS.get(cycle), stages)
 
     async def notify(self,
                      group,
@@ -555,21 +1280,41 @@ class Controller(object):
         if (condition(data)):
             return data
 
-        loop = asyncio.get_running_loop()
-        fut = loop.create_future()
-
-        def close_upon_condition(data):
-            nonlocal condition
-            nonlocal fut
-            if (condition(data)):
-                fut.set_result(data)
-
-        monitor = await self.monitor(group, request_id, subid,
-                                     close_upon_condition, mech_id, cycle,
-                                     threshold)
-        data = await asyncio.wait_for(fut, timeout=timeout)
-        monitor.close()
-        return data
+        # concurrent waiters on the same key share one subscription
+        key, _ = create_access_payload(group, request_id, subid, mech_id,
+                                       MonitorCycle.pull, 0.01)
+        group_key = (key, cycle, threshold)
+        notify_group = self.notify_groups.get(group_key)
+        if (notify_group is not None and notify_group.subscription is not None
+                and not notify_group.subscription.active):
+            # its monitor connection is gone, start over on a new one
+            del self.notify_groups[group_key]
+            notify_group = None
+        created = notify_group is None
+        if (created):
+            notify_group = NotifyGroup()
+            self.notify_groups[group_key] = notify_group
+        fut = asyncio.get_running_loop().create_future()
+        notify_group.add(condition, fut)
+        try:
+            if (created):
+                try:
+                    notify_group.subscription = await self.monitor(
+                        group, request_id, subid, notify_group, mech_id,
+                        cycle, threshold)
+                except BaseException as e:
+                    # waiters that joined meanwhile fail with the creator
+                    self.notify_groups.pop(group_key, None)
+                    notify_group.fail(e)
+                    raise
+            return await asyncio.wait_for(fut, timeout=timeout)
+        finally:
+            # the last waiter to finish or time out tears the group down
+            notify_group.remove(fut)
+            if (len(notify_group) == 0
+                    and self.notify_groups.get(group_key) is notify_group):
+                del self.notify_groups[group_key]
+                notify_group.close()
 
     async def notify_motor_ready(self,
                                  target,
@@ -645,29 +1390,73 @@ class Controller(object):
         self.sequid += 1
         return (key, flex_node)
 
+    def create_command_payload(self, command_name, params=None):
+        params = [] if params is None else params
+        template = get_command_template(
+            command_name,
+            tuple((param_name, param_value is not None)
+                  for (param_name, param_value) in params))
+        values = {"sequid": self.sequid}
+        for i, (_, param_value) in enumerate(params):
+            values["p{}".format(i)] = param_value
+        key = "command_name:{};sequid:{};".format(command_name, self.sequid)
+        self.sequid += 1
+        return (key, template.render(values))
+
     async def move(self, v, command_name, move_type, timeout=5.0):
-        params = []
-        if (command_name == "MoveXR" or command_name == "MoveX"):
-            params.append(('X', v[0]))
-            params.append(('Y', v[1]))
-            params.append(('Z', v[2]))
-            params.append(('r', v[3]))
-            params.append(('p', v[4]))
-            params.append(('y', v[5]))
-            params.append(('conf', 0))
-        else:
-            params.append(('angle1', v[0]))
-            params.append(('angle2', v[1]))
-            params.append(('angle3', v[2]))
-            params.append(('angle4', v[3]))
-            params.append(('angle5', v[4]))
-            params.append(('angle6', v[5]))
-        if (move_type != MoveType.thru):
-            params.append(
-                ("PAUSE" if move_type == MoveType.positioning else "END",
-                 None))
-        key, flex_node = self.create_command_xml(command_name, params)
-        return await self.send_and_wait_reply(key, flex_node, timeout)
+        key, payload = self.create_command_payload(
+            command_name, create_move_params(v, command_name, move_type))
+        return await self.send_payload_and_wait_reply(key, payload, timeout)
+
+    async def stream_trajectory(self,
+                                points,
+                                command="MoveJ",
+                                window=8,
+                                progress=None,
+                                timeout=5.0):
+        # keeps up to `window` move commands queued on the controller;
+        # every point but the last is sent as MoveType.thru. Each queued
+        # command holds an in_flight slot, so the window cannot exceed
+        # max_in_flight without waiting on itself
+        if (window > self.max_in_flight):
+            raise ValueError("window {} exceeds max_in_flight {}".format(
+                window, self.max_in_flight))
+        points = np.asarray(points)
+        pending = deque()
+        results = []
+
+        async def complete():
+            key, futs, sent = pending.popleft()
+            try:
+                result = (await self.wait_replies([key], futs, timeout,
+                                                  sent))[0]
+            finally:
+                self.in_flight.release()
+            results.append(result)
+            if (progress is not None):
+                progress(len(results) - 1, result)
+
+        try:
+            for i, point in enumerate(points):
+                move_type = (MoveType.end
+                             if i == len(points) - 1 else MoveType.thru)
+                key, payload = self.create_command_payload(
+                    command, create_move_params(point, command, move_type))
+                await asyncio.wait_for(self.in_flight.acquire(),
+                                       timeout=timeout)
+                pending.append((key, self.post_payload([key], payload),
+                                time.perf_counter()))
+                if (len(pending) >= window):
+                    await complete()
+            while pending:
+                await complete()
+        finally:
+            for key, futs, _ in pending:
+                for fut in futs:
+                    fut.cancel()
+                    self.abandon_future(key, fut)
+                self.in_flight.release()
+        return results
 
     async def move_by(self, shift, move_type, timeout=5.0):
         return await self.move(shift, "MoveXR", move_type, timeout)
@@ -682,11 +1471,13 @@ class Controller(object):
         return await self.move(angles, "MoveJ", move_type, timeout)
 
     async def start_motor(self, timeout=5.0):
-        key, flex_node = self.create_command_xml("selectMotorOn", [('on', 1)])
-        await self.send_and_wait_reply(key, flex_node, timeout)
+        key, payload = self.create_command_payload("selectMotorOn",
+                                                   [('on', 1)])
+        await self.send_payload_and_wait_reply(key, payload, timeout)
         await asyncio.sleep(0.05)  # sleep to send ACK
-        key, flex_node = self.create_command_xml("selectMotorOn", [('on', 0)])
-        return await self.send_and_wait_reply(key, flex_node, timeout)
+        key, payload = self.create_command_payload("selectMotorOn",
+                                                   [('on', 0)])
+        return await self.send_payload_and_wait_reply(key, payload, timeout)
 
     async def start_motor_until_current_ready(self,
                                               l1norm_threshold=0.7,
@@ -703,8 +1494,8 @@ class Controller(object):
             timeout=timeout)
 
     async def stop_motor(self, timeout=5.0):
-        key, flex_node = self.create_command_xml("selectMotorOff")
-        return await self.send_and_wait_reply(key, flex_node, timeout)
+        key, payload = self.create_command_payload("selectMotorOff")
+        return await self.send_payload_and_wait_reply(key, payload, timeout)
 
     async def stop_motor_until_current_drains(self,
                                               l1norm_threshold=0.1,
@@ -722,37 +1513,232 @@ class Controller(object):
 
 
 class MonitorClientProtocol(asyncio.Protocol):
-    def __init__(self, key, callback):
-        self.key = key
-        self.callback = callback
+    channel = MONITOR
+
+    def __init__(self,
+                 subscriptions,
+                 fast_decode=False,
+                 stats=None,
+                 capture=None,
+                 executor=None,
+                 max_pending=64):
+        self.subscriptions = subscriptions
+        self.fast_decode = fast_decode
+        self.stats = stats
+        self.capture = capture
+        self.decoder = FrameDecoder(self.dispatch)
+        self.frames = []
+        self.skipped = 0
+        # a late sample is worth less than the next one, so drop the oldest
+        self.decoder_queue = None if executor is None else DecoderQueue(
+            executor, self.deliver, fast_decode, max_pending, True, stats)
+        # time.monotonic() at which the chunk holding the sample being
+        # delivered was received, for callbacks that need to know
+        self.arrival = None
 
     def connection_made(self, transport):
-        print('connection made for monitor')
+        logger.info('connection made for monitor')
+        if (self.decoder_queue is not None):
+            self.decoder_queue.transport = transport
 
     def data_received(self, data):
-        print("data received")
-        elements = parse_xml_replies(data)
-        for element in elements:
-            if (get_reply_type(element) != XMLReplyType.data_update):
-                continue
-            key, data_node = get_access_xml_key(element)
-            if key != self.key:
+        logger.debug("data received")
+        arrival = time.monotonic()
+        if (self.stats is not None):
+            self.stats.bytes_in += len(data)
+        if (self.capture is not None):
+            self.capture.record(self.channel, INBOUND, data)
+        self.arrival = arrival
+        self.decoder.feed(data)
+        if (self.frames):
+            self.decoder_queue.submit(self.frames, arrival)
+            self.frames = []
+
+    def dispatch(self, frame):
+        if (not self.wanted(frame)):
+            self.skipped += 1
+            return
+        if (self.decoder_queue is not None):
+            # the frame view is released once this returns
+            self.frames.append(bytes(frame))
+            if (self.stats is not None):
+                self.stats.frames_in += 1
+            return
+        if (self.stats is None):
+            replies = decode_frame(frame, self.fast_decode)
+        else:
+            start = time.perf_counter()
+            replies = decode_frame(frame, self.fast_decode)
+            self.stats.parse_time.record(time.perf_counter() - start)
+            self.stats.frames_in += 1
+        self.deliver(replies, self.arrival)
+
+    def wanted(self, frame):
+        # the controller keeps pushing keys nobody listens to any more, so
+        # their frames are dropped before they are decoded
+        keys = find_data_keys(frame)
+        return (len(keys) == 0
+                or any(key in self.subscriptions for key in keys))
+
+    def deliver(self, replies, arrival=None):
+        self.arrival = arrival
+        for reply in replies:
+            if (reply.kind != XMLReplyType.data_update):
                 continue
-            self.callback(parse_xml_value(data_node))
+            if (self.stats is not None):
+                self.stats.record_arrival(reply.key, arrival)
+            # a failing callback must not reach data_received, where asyncio
+            # would close the connection every other subscription shares
+            for callback in tuple(self.subscriptions.get(reply.key, ())):
+                try:
+                    callback(reply.values)
+                except Exception:
+                    logger.exception('monitor callback failed, key = %s',
+                                     reply.key)
 
     def connection_lost(self, exc):
-        print('Connection for monitor lost')
+        logger.info('Connection for monitor lost')
+        # nothing pushes to the waiters any more
+        for callbacks in self.subscriptions.values():
+            for callback in callbacks:
+                if (isinstance(callback, NotifyGroup)):
+                    callback.fail(ConnectionError())
+
+
+class Subscription(object):
+    def __init__(self, monitor_controller, key, callback):
+        self.monitor_controller = monitor_controller
+        self.key = key
+        self.callback = callback
+
+    @property
+    def active(self):
+        # False once closed or once the monitor connection is lost
+        monitor_controller = self.monitor_controller
+        return (not monitor_controller.transport.is_closing()
+                and self.callback in monitor_controller.subscriptions.get(
+                    self.key, ()))
+
+    def close(self):
+        self.monitor_controller.unsubscribe(self)
+
+
+class NotifyGroup(object):
+    # called once per decoded sample and checks every waiter's condition
+    # against the same array
+    def __init__(self):
+        self.waiters = []
+        self.subscription = None
+
+    def __len__(self):
+        return len(self.waiters)
+
+    def __call__(self, data):
+        for condition, fut in self.waiters:
+            if (fut.done()):
+                continue
+            try:
+                if (condition(data)):
+                    fut.set_result(data)
+            except Exception as e:
+                fut.set_exception(e)
+
+    def add(self, condition, fut):
+        self.waiters.append((condition, fut))
+
+    def remove(self, fut):
+        self.waiters = [
+            waiter for waiter in self.waiters if waiter[1] is not fut
+        ]
+
+    def fail(self, exc):
+        for _, fut in self.waiters:
+            if (fut.done()):
+                continue
+            if (isinstance(exc, asyncio.CancelledError)):
+                fut.cancel()
+            else:
+                fut.set_exception(exc)
+
+    def close(self):
+        if (self.subscription is not None):
+            self.subscription.close()
+            self.subscription = None
 
 
 class MonitorController(object):
     @classmethod
-    async def create(cls, ip, port, key, flex_node, callback):
+    async def create(cls,
+                     ip,
+                     port,
+                     key=None,
+                     flex_node=None,
+                     callback=None,
+                     fast_decode=True,
+                     stats=False,
+                     capture=None,
+                     executor=None,
+                     max_pending=64,
+                     idle_timeout=None):
+        # capture is a CaptureWriter shared with the owning Controller
         self = cls()
+        self.subscriptions = {}
+        self.requests = {}
+        self.idle_timeout = idle_timeout
+        self.idle_handle = None
+        self.statistics = ConnectionStats() if stats else None
         loop = asyncio.get_running_loop()
         self.transport, self.protocol = await loop.create_connection(
-            lambda: MonitorClientProtocol(key, callback), ip, port)
-        self.transport.write(create_payload(flex_node))
+            lambda: MonitorClientProtocol(self.subscriptions, fast_decode,
+                                          self.statistics, capture, executor,
+                                          max_pending), ip, port)
+        if (key is not None):
+            self.subscribe(key, flex_node, callback)
         return self
 
+    @property
+    def arrival(self):
+        return self.protocol.arrival
+
+    def subscribe(self, key, flex_node, callback, period=None, stages=None):
+        # the push request is only sent when the key is new on this connection
+        # or is requested with a different cycle/threshold
+        payload = create_payload(flex_node)
+        if (self.requests.get(key) != payload):
+            self.transport.write(payload)
+            self.requests[key] = payload
+            if (self.protocol.capture is not None):
+                self.protocol.capture.record(MONITOR, OUTBOUND, payload)
+            if (self.statistics is not None):
+                self.statistics.bytes_out += len(payload)
+                self.statistics.frames_out += 1
+                self.statistics.set_period(key, period)
+        if (stages):
+            callback = Pipeline(stages, callback)
+        if (self.idle_handle is not None):
+            self.idle_handle.cancel()
+            self.idle_handle = None
+        self.subscriptions.setdefault(key, []).append(callback)
+        return Subscription(self, key, callback)
+
+    def unsubscribe(self, subscription):
+        # there is no request to stop a push, so the controller keeps sending
+        # the key until the connection closes; its frames are skipped unread
+        # and the request is kept so a later subscribe does not repeat it.
+        # The connection stays open for the next subscriber unless
+        # idle_timeout is set
+        callbacks = self.subscriptions.get(subscription.key, [])
+        if (subscription.callback in callbacks):
+            callbacks.remove(subscription.callback)
+        if (len(callbacks) == 0):
+            self.subscriptions.pop(subscription.key, None)
+        if (len(self.subscriptions) == 0 and self.idle_timeout is not None
+                and self.idle_handle is None):
+            self.idle_handle = asyncio.get_running_loop().call_later(
+                self.idle_timeout, self.close)
+
     def close(self):
+        if (self.idle_handle is not None):
+            self.idle_handle.cancel()
+            self.idle_handle = None
         self.transport.close()
@@ -0,0 +1,294 @@
+import argparse
+import asyncio
+import logging
+import os
+import struct
+import time
+import numpy as np
+from fulcrane.controller import (ACCESS_CODE_MAP, MIN_THRESHOLD, Controller,
+                                 MonitorCycle)
+
+logger = logging.getLogger(__name__)
+
+# every message in both directions is a little-endian header followed by
+# length payload bytes:
+#   uint8   type
+#   uint16  stream id (decimation for SUBSCRIBE)
+#   uint16  payload length
+# SUBSCRIBE / UNSUBSCRIBE payload: uint8 mech_id + ASCII variable name
+# SUBSCRIBED payload:              uint8 mech_id + ASCII variable name
+# SAMPLE payload:                  float64 host timestamp + float32 values
+# ERROR payload:                   UTF-8 message
+MESSAGE_HEADER = struct.Struct('<BHH')
+TIMESTAMP_FORMAT = struct.Struct('<d')
+SUBSCRIBE = 1
+UNSUBSCRIBE = 2
+SUBSCRIBED = 3
+SAMPLE = 4
+ERROR = 5
+DEFAULT_SOCKET = '/tmp/fulcrane.sock'
+
+
+def create_message(kind, stream_id, payload=b''):
+    return MESSAGE_HEADER.pack(kind, stream_id, len(payload)) + payload
+
+
+def create_stream_payload(name, mech_id):
+    return bytes([mech_id]) + name.encode('ascii')
+
+
+def parse_stream_payload(payload):
+    return payload[1:].decode('ascii'), payload[0]
+
+
+async def read_message(reader):
+    kind, stream_id, length = MESSAGE_HEADER.unpack(
+        await reader.readexactly(MESSAGE_HEADER.size))
+    return kind, stream_id, await reader.readexactly(length)
+
+
+class Stream(object):
+    # one monitor subscription, encoded once per sample and fanned out to
+    # every client that subscribed to it
+    def __init__(self, stream_id, name, mech_id):
+        self.stream_id = stream_id
+        self.name = name
+        self.mech_id = mech_id
+        self.clients = {}
+        self.subscription = None
+        self.samples = 0
+
+    def __call__(self, values):
+        self.samples += 1
+        if (len(self.clients) == 0):
+            return
+        message = create_message(
+            SAMPLE, self.stream_id,
+            TIMESTAMP_FORMAT.pack(time.time()) +
+            np.asarray(values, dtype='<f4').tobytes())
+        for client, decimation in self.clients.items():
+            if (self.samples % decimation == 0):
+                client.send(message)
+
+
+class Client(object):
+    def __init__(self, writer, max_buffer):
+        self.writer = writer
+        self.max_buffer = max_buffer
+        self.streams = set()
+        self.dropped = 0
+        self.task = asyncio.current_task()
+
+    def send(self, message):
+        # a consumer that cannot keep up loses samples instead of stalling
+        # the others or growing the daemon's memory
+        transport = self.writer.transport
+        if (transport.is_closing()):
+            return
+        if (transport.get_write_buffer_size() > self.max_buffer):
+            self.dropped += 1
+            return
+        self.writer.write(message)
+
+
+class Daemon(object):
+    @classmethod
+    async def create(cls,
+                     ip,
+                     port=9876,
+                     path=DEFAULT_SOCKET,
+                     cycle=MonitorCycle.at5ms,
+                     threshold=MIN_THRESHOLD,
+                     max_buffer=1 << 16,
+                     **options):
+        # options are passed on to Controller.create
+        self = cls()
+        self.ip = ip
+        self.port = port
+        self.path = path
+        self.cycle = cycle
+        self.threshold = threshold
+        self.max_buffer = max_buffer
+        self.options = options
+        self.streams = {}
+        self.next_stream_id = 0
+        self.clients = set()
+        self.controller = await Controller.create(ip, port, **options)
+        if (os.path.exists(path)):
+            os.unlink(path)
+        self.server = await asyncio.start_unix_server(self.serve, path)
+        self.watcher = asyncio.ensure_future(self.watch())
+        return self
+
+    async def get_stream(self, name, mech_id):
+        # subscriptions stay warm after the last client leaves so the next
+        # one starts receiving immediately
+        stream = self.streams.get((name, mech_id))
+        if (stream is None):
+            stream = Stream(self.next_stream_id, name, mech_id)
+            self.next_stream_id += 1
+            await self.start_stream(stream)
+            # a stream is only registered once it is subscribed; a client
+            # that asked for it meanwhile may have registered it first
+            if ((name, mech_id) in self.streams):
+                stream.subscription.close()
+                return self.streams[(name, mech_id)]
+            self.streams[(name, mech_id)] = stream
+        return stream
+
+    async def start_stream(self, stream):
+        stream.subscription = await self.controller.monitor(
+            *ACCESS_CODE_MAP[stream.name], stream, stream.mech_id, self.cycle,
+            self.threshold)
+
+    def monitor_lost(self):
+        monitor_controller = self.controller.monitor_controller
+        return (len(self.streams) > 0
+                and (monitor_controller is None
+                     or monitor_controller.transport.is_closing()))
+
+    async def watch(self, interval=1.0):
+        # reconnects and resubscribes every stream if the controller drops
+        # either connection; a lost monitor connection alone is reopened by
+        # the first resubscription
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if (self.controller.transport.is_closing()):
+                    logger.warning('controller connection lost, reconnecting')
+                    self.controller.close()
+                    self.controller = await Controller.create(
+                        self.ip, self.port, **self.options)
+                elif (self.monitor_lost()):
+                    logger.warning('monitor connection lost, resubscribing')
+                else:
+                    continue
+                for stream in self.streams.values():
+                    await self.start_stream(stream)
+            except OSError as e:
+                logger.warning('reconnect failed: %r', e)
+
+    async def serve(self, reader, writer):
+        client = Client(writer, self.max_buffer)
+        self.clients.add(client)
+        try:
+            while True:
+                kind, argument, payload = await read_message(reader)
+                try:
+                    name, mech_id = parse_stream_payload(payload)
+                    if (name not in ACCESS_CODE_MAP):
+                        raise KeyError(name)
+                except (IndexError, UnicodeDecodeError, KeyError) as e:
+                    writer.write(
+                        create_message(ERROR, 0, repr(e).encode('utf-8')))
+                    continue
+                if (kind == SUBSCRIBE):
+                    try:
+                        stream = await self.get_stream(name, mech_id)
+                    except OSError as e:
+                        writer.write(
+                            create_message(ERROR, 0, repr(e).encode('utf-8')))
+                        continue
+                    stream.clients[client] = max(argument, 1)
+                    client.streams.add(stream)
+                    writer.write(
+                        create_message(SUBSCRIBED, stream.stream_id, payload))
+                elif (kind == UNSUBSCRIBE):
+                    stream = self.streams.get((name, mech_id))
+                    if (stream is not None):
+                        stream.clients.pop(client, None)
+                        client.streams.discard(stream)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for stream in client.streams:
+                stream.clients.pop(client, None)
+            self.clients.discard(client)
+            writer.close()
+
+    async def close(self):
+        # clients are disconnected first: wait_closed() waits for their
+        # connections on newer Pythons, and on older ones their handlers
+        # would be left pending
+        self.watcher.cancel()
+        self.server.close()
+        clients = list(self.clients)
+        for client in clients:
+            client.writer.close()
+        await asyncio.gather(*[client.task for client in clients],
+                             return_exceptions=True)
+        await self.server.wait_closed()
+        self.controller.close()
+        if (os.path.exists(self.path)):
+            os.unlink(self.path)
+
+
+class DaemonClient(object):
+    @classmethod
+    async def connect(cls, path=DEFAULT_SOCKET):
+        self = cls()
+        self.reader, self.writer = await asyncio.open_unix_connection(path)
+        self.names = {}
+        return self
+
+    def subscribe(self, name, mech_id=1, decimation=1):
+        # the daemon answers with SUBSCRIBED before samples of the stream
+        self.writer.write(
+            create_message(SUBSCRIBE, decimation,
+                           create_stream_payload(name, mech_id)))
+
+    def unsubscribe(self, name, mech_id=1):
+        self.writer.write(
+            create_message(UNSUBSCRIBE, 0,
+                           create_stream_payload(name, mech_id)))
+
+    async def read(self):
+        # next sample as (name, mech_id, timestamp, values)
+        while True:
+            kind, stream_id, payload = await read_message(self.reader)
+            if (kind == SAMPLE):
+                name, mech_id = self.names[stream_id]
+                timestamp, = TIMESTAMP_FORMAT.unpack_from(payload)
+                values = np.frombuffer(payload,
+                                       dtype='<f4',
+                                       offset=TIMESTAMP_FORMAT.size)
+                return name, mech_id, timestamp, values
+            elif (kind == SUBSCRIBED):
+                self.names[stream_id] = parse_stream_payload(payload)
+            elif (kind == ERROR):
+                raise ValueError(payload.decode('utf-8'))
+
+    def close(self):
+        self.writer.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="fulcrane daemon")
+    parser.add_argument('ip')
+    parser.add_argument('--port', type=int, default=9876)
+    parser.add_argument('--socket', default=DEFAULT_SOCKET)
+    parser.add_argument('--cycle',
+                        default='at5ms',
+                        choices=[c.name for c in MonitorCycle
+                                 if c != MonitorCycle.pull])
+    parser.add_argument('--preload',
+                        nargs='*',
+                        default=[],
+                        help="variables subscribed at startup")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    daemon = await Daemon.create(args.ip,
+                                 args.port,
+                                 args.socket,
+                                 cycle=MonitorCycle[args.cycle])
+    for name in args.preload:
+        await daemon.get_stream(name, 1)
+    logger.info('serving %s on %s', args.ip, args.socket)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await daemon.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
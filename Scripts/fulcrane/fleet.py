@@ -0,0 +1,160 @@
+import asyncio
+import time
+import numpy as np
+from fulcrane.controller import (ACCESS_CODE_MAP, MIN_THRESHOLD, Controller,
+                                 MonitorCycle)
+
+
+def stack(results, width=6):
+    # one row per arm; arms that failed or returned nothing are NaN
+    values = np.full((len(results), width), np.nan, dtype=np.float64)
+    for i, result in enumerate(results):
+        if (result is None or isinstance(result, BaseException)):
+            continue
+        values[i] = result
+    return values
+
+
+class FleetMonitor(object):
+    def __init__(self, size, width, callback):
+        self.latest = np.full((size, width), np.nan, dtype=np.float64)
+        self.timestamps = np.full(size, np.nan)
+        self.callback = callback
+        self.subscriptions = []
+
+    def update(self, index, values):
+        self.latest[index] = values
+        self.timestamps[index] = time.time()
+        if (self.callback is not None):
+            self.callback(index, values)
+
+    @property
+    def active(self):
+        # per arm, False where subscribing failed or the connection is gone
+        return np.array([
+            subscription is not None and subscription.active
+            for subscription in self.subscriptions
+        ])
+
+    def close(self):
+        for subscription in self.subscriptions:
+            if (subscription is not None):
+                subscription.close()
+        self.subscriptions = []
+
+
+class Fleet(object):
+    @classmethod
+    async def create(cls,
+                     addresses,
+                     port=9876,
+                     max_connecting=8,
+                     timeout=5.0,
+                     **options):
+        # addresses are IPs or (ip, port) pairs; at most max_connecting
+        # connections are being set up at any time and an arm that cannot
+        # connect is left as None instead of failing the fleet
+        self = cls()
+        self.addresses = [
+            address if isinstance(address, tuple) else (address, port)
+            for address in addresses
+        ]
+        self.timeout = timeout
+        self.options = options
+        self.connecting = asyncio.Semaphore(max_connecting)
+        self.controllers = [None] * len(self.addresses)
+        self.errors = [None] * len(self.addresses)
+        await self.reconnect()
+        return self
+
+    def __len__(self):
+        return len(self.controllers)
+
+    async def connect(self, index):
+        ip, port = self.addresses[index]
+        async with self.connecting:
+            try:
+                self.controllers[index] = await asyncio.wait_for(
+                    Controller.create(ip, port, **self.options),
+                    timeout=self.timeout)
+                self.errors[index] = None
+            except (OSError, asyncio.TimeoutError) as e:
+                self.controllers[index] = None
+                self.errors[index] = e
+
+    async def reconnect(self):
+        await asyncio.gather(*[
+            self.connect(i) for i, controller in enumerate(self.controllers)
+            if controller is None or controller.transport.is_closing()
+        ])
+
+    async def fan_out(self, function, timeout=None):
+        # awaits function(index, controller) for every arm concurrently; each
+        # arm gets its own timeout and its exception is returned in its slot
+        timeout = self.timeout if timeout is None else timeout
+
+        async def run_one(index, controller):
+            if (controller is None):
+                raise ConnectionError(self.addresses[index])
+            return await asyncio.wait_for(function(index, controller),
+                                          timeout=timeout)
+
+        results = await asyncio.gather(
+            *[run_one(i, c) for i, c in enumerate(self.controllers)],
+            return_exceptions=True)
+        self.errors = [
+            result if isinstance(result, BaseException) else None
+            for result in results
+        ]
+        return results
+
+    async def call(self, method, *args, timeout=None, **kwargs):
+        def call_one(index, controller):
+            return getattr(controller, method)(*args, **kwargs)
+
+        return await self.fan_out(call_one, timeout)
+
+    async def access_all(self, name, mech_id=1, timeout=None, width=6):
+        return stack(
+            await self.call("access",
+                            *ACCESS_CODE_MAP[name],
+                            mech_id,
+                            timeout=timeout), width)
+
+    async def start_motor_until_current_ready(self, timeout=None, **kwargs):
+        return stack(await self.call("start_motor_until_current_ready",
+                                     timeout=timeout,
+                                     **kwargs))
+
+    async def stop_motor_until_current_drains(self, timeout=None, **kwargs):
+        return stack(await self.call("stop_motor_until_current_drains",
+                                     timeout=timeout,
+                                     **kwargs))
+
+    async def monitor_all(self,
+                          name,
+                          callback=None,
+                          mech_id=1,
+                          cycle=MonitorCycle.at5ms,
+                          threshold=MIN_THRESHOLD,
+                          width=6):
+        # aggregates one subscription per arm into monitor.latest (N, width)
+        monitor = FleetMonitor(len(self), width, callback)
+
+        def subscribe(index, controller):
+            return controller.monitor(
+                *ACCESS_CODE_MAP[name],
+                lambda values: monitor.update(index, values), mech_id, cycle,
+                threshold)
+
+        results = await self.fan_out(subscribe)
+        monitor.subscriptions = [
+            None if isinstance(result, BaseException) else result
+            for result in results
+        ]
+        return monitor
+
+    def close(self):
+        for controller in self.controllers:
+            if (controller is not None):
+                controller.close()
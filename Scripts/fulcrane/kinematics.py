@@ -0,0 +1,158 @@
+import numpy as np
+
+# poses are [X, Y, Z, r, p, y] in mm and degrees like AcsToolTipPos and
+# MoveX; r, p, y are taken as fixed-axis X, Y, Z rotations (R = Rz Ry Rx)
+
+
+def pose_to_matrix(pose):
+    pose = np.asarray(pose, dtype=np.float64)
+    angles = np.deg2rad(pose[..., 3:6])
+    cr, cp, cy = np.moveaxis(np.cos(angles), -1, 0)
+    sr, sp, sy = np.moveaxis(np.sin(angles), -1, 0)
+    T = np.zeros(pose.shape[:-1] + (4, 4))
+    T[..., 0, 0] = cy * cp
+    T[..., 0, 1] = cy * sp * sr - sy * cr
+    T[..., 0, 2] = cy * sp * cr + sy * sr
+    T[..., 1, 0] = sy * cp
+    T[..., 1, 1] = sy * sp * sr + cy * cr
+    T[..., 1, 2] = sy * sp * cr - cy * sr
+    T[..., 2, 0] = -sp
+    T[..., 2, 1] = cp * sr
+    T[..., 2, 2] = cp * cr
+    T[..., :3, 3] = pose[..., :3]
+    T[..., 3, 3] = 1.0
+    return T
+
+
+def matrix_to_pose(T):
+    T = np.asarray(T, dtype=np.float64)
+    pose = np.empty(T.shape[:-2] + (6, ))
+    pose[..., :3] = T[..., :3, 3]
+    pose[..., 3] = np.arctan2(T[..., 2, 1], T[..., 2, 2])
+    pose[..., 4] = np.arctan2(-T[..., 2, 0],
+                              np.hypot(T[..., 0, 0], T[..., 1, 0]))
+    pose[..., 5] = np.arctan2(T[..., 1, 0], T[..., 0, 0])
+    pose[..., 3:] = np.rad2deg(pose[..., 3:])
+    return pose
+
+
+def as_matrix(frame):
+    # frames are given either as a 4x4 matrix or as a pose
+    if (frame is None):
+        return np.eye(4)
+    frame = np.asarray(frame, dtype=np.float64)
+    return frame if frame.shape == (4, 4) else pose_to_matrix(frame)
+
+
+def pose_error(a, b):
+    # position distance in mm and largest wrapped angle difference in degrees
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    position = np.linalg.norm(a[..., :3] - b[..., :3], axis=-1)
+    angle = np.abs((a[..., 3:] - b[..., 3:] + 180.0) % 360.0 - 180.0)
+    return position, angle.max(axis=-1)
+
+
+class DHChain(object):
+    def __init__(self,
+                 a,
+                 alpha,
+                 d,
+                 offset=None,
+                 sign=None,
+                 modified=False,
+                 base=None,
+                 tool=None):
+        # a and d in mm, alpha in degrees, one entry per joint; the DH angle
+        # of joint i is sign[i] * angle[i] + offset[i] in degrees, so the
+        # controller's zero position and axis directions can be matched.
+        # modified selects Craig's convention instead of the classic one
+        self.a = np.asarray(a, dtype=np.float64)
+        self.alpha = np.deg2rad(np.asarray(alpha, dtype=np.float64))
+        self.d = np.asarray(d, dtype=np.float64)
+        n = len(self.a)
+        if (len(self.alpha) != n or len(self.d) != n):
+            raise ValueError("a, alpha and d must have the same length")
+        self.offset = np.zeros(n) if offset is None else np.asarray(
+            offset, dtype=np.float64)
+        self.sign = np.ones(n) if sign is None else np.asarray(
+            sign, dtype=np.float64)
+        self.modified = modified
+        self.base = as_matrix(base)
+        self.tool = as_matrix(tool)
+        self.cos_alpha = np.cos(self.alpha)
+        self.sin_alpha = np.sin(self.alpha)
+
+    def __len__(self):
+        return len(self.a)
+
+    def link_transforms(self, angles):
+        # (N, joints, 4, 4) transforms of every link for (N, joints) angles
+        theta = np.deg2rad(angles * self.sign + self.offset)
+        ct, st = np.cos(theta), np.sin(theta)
+        ca, sa = self.cos_alpha, self.sin_alpha
+        T = np.zeros(theta.shape + (4, 4))
+        if (self.modified):
+            T[..., 0, 0] = ct
+            T[..., 0, 1] = -st
+            T[..., 0, 3] = self.a
+            T[..., 1, 0] = st * ca
+            T[..., 1, 1] = ct * ca
+            T[..., 1, 2] = -sa
+            T[..., 1, 3] = -sa * self.d
+            T[..., 2, 0] = st * sa
+            T[..., 2, 1] = ct * sa
+            T[..., 2, 2] = ca
+            T[..., 2, 3] = ca * self.d
+        else:
+            T[..., 0, 0] = ct
+            T[..., 0, 1] = -st * ca
+            T[..., 0, 2] = st * sa
+            T[..., 0, 3] = self.a * ct
+            T[..., 1, 0] = st
+            T[..., 1, 1] = ct * ca
+            T[..., 1, 2] = -ct * sa
+            T[..., 1, 3] = self.a * st
+            T[..., 2, 1] = sa
+            T[..., 2, 2] = ca
+            T[..., 2, 3] = self.d
+        T[..., 3, 3] = 1.0
+        return T
+
+    def transform(self, angles):
+        # tool flange transform in the base frame, (4, 4) or (N, 4, 4)
+        angles = np.asarray(angles, dtype=np.float64)
+        if (angles.shape[-1] != len(self)):
+            raise ValueError("expected {} joint angles, got {}".format(
+                len(self), angles.shape[-1]))
+        links = self.link_transforms(angles)
+        T = np.broadcast_to(self.base, angles.shape[:-1] + (4, 4))
+        # one batched product per joint instead of a loop over samples
+        for i in range(len(self)):
+            T = np.matmul(T, links[..., i, :, :])
+        return np.matmul(T, self.tool)
+
+    def forward(self, angles):
+        # [X, Y, Z, r, p, y] for one sample (6,) or a batch (N, 6)
+        return matrix_to_pose(self.transform(angles))
+
+    __call__ = forward
+
+    async def verify(self,
+                     controller,
+                     mech_id=1,
+                     position_tolerance=1.0,
+                     angle_tolerance=0.5,
+                     timeout=5.0):
+        # joints and pose come from one dataRequest so they are sampled
+        # together; raises ValueError when the parameters do not match the
+        # controller's own kinematics
+        values = await controller.access_many(
+            ["AcsAxisTheta", "AcsToolTipPos"], mech_id, timeout)
+        position, angle = pose_error(self.forward(values["AcsAxisTheta"]),
+                                     values["AcsToolTipPos"])
+        if (position > position_tolerance or angle > angle_tolerance):
+            raise ValueError(
+                "pose differs from controller by {:.3f} mm, {:.3f} deg".format(
+                    position, angle))
+        return position, angle
@@ -0,0 +1,107 @@
+import mmap
+import struct
+import time
+import numpy as np
+from fulcrane.controller import ACCESS_CODE_MAP, MIN_THRESHOLD, MonitorCycle
+
+# fixed layout shared with non-Python readers (all little-endian):
+#   0  char[4]  magic "FCPS"
+#   4  uint32   layout version
+#   8  uint64   sequence counter, odd while a frame is being written
+#   16 float64  host timestamp in seconds
+#   24 float32  joint angles [6]
+#   48 float32  tool pose [6]
+POSE_CHANNEL_MAGIC = b'FCPS'
+POSE_CHANNEL_VERSION = 1
+HEADER_FORMAT = struct.Struct('<4sI')
+SEQUENCE_FORMAT = struct.Struct('<Q')
+SEQUENCE_OFFSET = 8
+FRAME_FORMAT = struct.Struct('<d6f6f')
+FRAME_OFFSET = 16
+POSE_CHANNEL_SIZE = FRAME_OFFSET + FRAME_FORMAT.size
+
+
+class PosePublisher(object):
+    def __init__(self, path, clock=time.time):
+        self.clock = clock
+        self.file = open(path, 'w+b')
+        self.file.truncate(POSE_CHANNEL_SIZE)
+        self.buffer = mmap.mmap(self.file.fileno(), POSE_CHANNEL_SIZE)
+        HEADER_FORMAT.pack_into(self.buffer, 0, POSE_CHANNEL_MAGIC,
+                                POSE_CHANNEL_VERSION)
+        self.sequence = 0
+        SEQUENCE_FORMAT.pack_into(self.buffer, SEQUENCE_OFFSET, self.sequence)
+        self.joint = np.zeros(6, dtype=np.float32)
+        self.pose = np.zeros(6, dtype=np.float32)
+        self.subscriptions = []
+
+    def publish(self):
+        # seqlock: readers retry whenever the counter is odd or changed while
+        # they copied the frame, so they never see a torn sample
+        self.sequence += 1
+        SEQUENCE_FORMAT.pack_into(self.buffer, SEQUENCE_OFFSET, self.sequence)
+        FRAME_FORMAT.pack_into(self.buffer, FRAME_OFFSET, self.clock(),
+                               *self.joint, *self.pose)
+        self.sequence += 1
+        SEQUENCE_FORMAT.pack_into(self.buffer, SEQUENCE_OFFSET, self.sequence)
+
+    def update_joint(self, values):
+        self.joint[:] = values
+        self.publish()
+        return False
+
+    def update_pose(self, values):
+        self.pose[:] = values
+        self.publish()
+        return False
+
+    async def subscribe(self,
+                        controller,
+                        mech_id=1,
+                        cycle=MonitorCycle.at5ms,
+                        threshold=MIN_THRESHOLD):
+        joint = await controller.monitor(*ACCESS_CODE_MAP["AcsAxisTheta"],
+                                         self.update_joint, mech_id, cycle,
+                                         threshold)
+        pose = await controller.monitor(*ACCESS_CODE_MAP["AcsToolTipPos"],
+                                        self.update_pose, mech_id, cycle,
+                                        threshold)
+        self.subscriptions += [joint, pose]
+        return joint, pose
+
+    def close(self):
+        # samples must stop before the buffer they are written to goes
+        for subscription in self.subscriptions:
+            subscription.close()
+        self.subscriptions = []
+        self.buffer.close()
+        self.file.close()
+
+
+class PoseReader(object):
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.buffer = mmap.mmap(self.file.fileno(),
+                                POSE_CHANNEL_SIZE,
+                                access=mmap.ACCESS_READ)
+        magic, version = HEADER_FORMAT.unpack_from(self.buffer, 0)
+        if (magic != POSE_CHANNEL_MAGIC or version != POSE_CHANNEL_VERSION):
+            raise ValueError("not a pose channel: {}".format(path))
+
+    def read(self, retries=1000):
+        for _ in range(retries):
+            before, = SEQUENCE_FORMAT.unpack_from(self.buffer, SEQUENCE_OFFSET)
+            if (before % 2 == 0):
+                frame = FRAME_FORMAT.unpack_from(self.buffer, FRAME_OFFSET)
+                after, = SEQUENCE_FORMAT.unpack_from(self.buffer,
+                                                     SEQUENCE_OFFSET)
+                if (before == after):
+                    return (before // 2, frame[0],
+                            np.array(frame[1:7], dtype=np.float32),
+                            np.array(frame[7:13], dtype=np.float32))
+            time.sleep(0)  # let a writer in this process finish its frame
+        raise TimeoutError
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
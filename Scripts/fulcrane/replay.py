@@ -0,0 +1,73 @@
+import asyncio
+import time
+from fulcrane.capture import CONTROL, INBOUND, MONITOR, read_capture
+from fulcrane.controller import (ACCESS_CODE_MAP, ClientProtocol,
+                                 MonitorClientProtocol, MonitorCycle,
+                                 Subscription, create_access_payload)
+from fulcrane.stats import ConnectionStats
+
+
+class Replay(object):
+    # feeds the inbound side of a capture through the same protocols a live
+    # Controller uses; outbound records are only kept for their timing
+    def __init__(self, path, fast_decode=True, stats=False):
+        self.records = list(read_capture(path))
+        self.subscriptions = {}
+        self.pull_map = {}
+        self.statistics = ConnectionStats() if stats else None
+        self.protocols = {
+            CONTROL:
+            ClientProtocol(self.pull_map, fast_decode, self.statistics),
+            MONITOR:
+            MonitorClientProtocol(self.subscriptions, fast_decode,
+                                  self.statistics)
+        }
+
+    def subscribe(self, name, callback, mech_id=1):
+        key, _ = create_access_payload(*ACCESS_CODE_MAP[name], mech_id,
+                                       MonitorCycle.pull, 0.01)
+        self.subscriptions.setdefault(key, []).append(callback)
+        return Subscription(self, key, callback)
+
+    def unsubscribe(self, subscription):
+        callbacks = self.subscriptions.get(subscription.key, [])
+        if (subscription.callback in callbacks):
+            callbacks.remove(subscription.callback)
+        if (len(callbacks) == 0):
+            self.subscriptions.pop(subscription.key, None)
+
+    def summary(self, elapsed):
+        inbound = [r for r in self.records if r[2] == INBOUND]
+        size = sum(len(r[3]) for r in inbound)
+        return {
+            "records": len(inbound),
+            "bytes": size,
+            "elapsed": elapsed,
+            "records_per_sec": len(inbound) / elapsed if elapsed > 0 else None,
+            "bytes_per_sec": size / elapsed if elapsed > 0 else None
+        }
+
+    def run(self):
+        # as fast as possible, which measures decoding plus callbacks
+        start = time.perf_counter()
+        for _, channel, direction, data in self.records:
+            if (direction == INBOUND):
+                self.protocols[channel].data_received(data)
+        return self.summary(time.perf_counter() - start)
+
+    async def play(self, speed=1.0):
+        # keeps the captured spacing, scaled by speed, against absolute time
+        # so callbacks see the original rate and jitter
+        if (len(self.records) == 0):
+            return self.summary(0.0)
+        loop = asyncio.get_running_loop()
+        first = self.records[0][0]
+        start = loop.time()
+        for timestamp, channel, direction, data in self.records:
+            if (direction != INBOUND):
+                continue
+            delay = start + (timestamp - first) / speed - loop.time()
+            if (delay > 0):
+                await asyncio.sleep(delay)
+            self.protocols[channel].data_received(data)
+        return self.summary(loop.time() - start)
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import time
+from fulcrane.controller import ACCESS_CODE_MAP
+
+logger = logging.getLogger(__name__)
+
+
+class Poll(object):
+    # one (variable, mech_id, period) registration and its subscribers
+    def __init__(self, name, mech_id, interval, phase):
+        self.name = name
+        self.mech_id = mech_id
+        self.interval = interval
+        self.phase = phase
+        self.callbacks = []
+        self.value = None
+        self.timestamp = None
+
+    def due(self, tick):
+        return (tick - self.phase) % self.interval == 0
+
+    def publish(self, value, timestamp):
+        self.value = value
+        self.timestamp = timestamp
+        for callback in tuple(self.callbacks):
+            callback(value)
+
+
+class PollRegistration(object):
+    def __init__(self, scheduler, poll, callback):
+        self.scheduler = scheduler
+        self.poll = poll
+        self.callback = callback
+
+    def close(self):
+        self.scheduler.unregister(self)
+
+
+class PollScheduler(object):
+    # polls variables that cannot be pushed. Every tick the variables that
+    # are due are read with one dataRequest of at most max_batch variables,
+    # and each registration gets the phase that adds the fewest requests
+    def __init__(self,
+                 controller,
+                 tick=0.01,
+                 timeout=1.0,
+                 max_batch=32,
+                 horizon=1000):
+        self.controller = controller
+        self.tick = tick
+        self.timeout = timeout
+        self.max_batch = max_batch
+        self.horizon = horizon
+        self.polls = {}
+        self.in_flight = set()
+        self.task = None
+        self.ticks = 0
+        self.requests = 0
+
+    def choose_phase(self, interval):
+        # joining ticks that already send a request with room left is free;
+        # among equally cheap phases the least loaded one wins, which spreads
+        # full batches across ticks
+        horizon = min(self.horizon, max([interval] + [
+            poll.interval for poll in self.polls.values()
+        ]) * interval)
+        load = [0] * horizon
+        for poll in self.polls.values():
+            for tick in range(poll.phase, horizon, poll.interval):
+                load[tick] += 1
+        costs = [(sum(load[tick] % self.max_batch == 0
+                      for tick in range(phase, horizon, interval)),
+                  sum(load[tick] for tick in range(phase, horizon, interval)))
+                 for phase in range(interval)]
+        return costs.index(min(costs))
+
+    def register(self, name, period, callback, mech_id=1):
+        if (name not in ACCESS_CODE_MAP):
+            raise KeyError(name)
+        interval = max(1, round(period / self.tick))
+        poll = self.polls.get((name, mech_id, interval))
+        if (poll is None):
+            poll = Poll(name, mech_id, interval, self.choose_phase(interval))
+            self.polls[(name, mech_id, interval)] = poll
+        poll.callbacks.append(callback)
+        return PollRegistration(self, poll, callback)
+
+    def unregister(self, registration):
+        poll = registration.poll
+        if (registration.callback in poll.callbacks):
+            poll.callbacks.remove(registration.callback)
+        if (len(poll.callbacks) == 0):
+            self.polls.pop((poll.name, poll.mech_id, poll.interval), None)
+
+    async def request(self, items, polls):
+        try:
+            values = await self.controller.access_batch(items, self.timeout)
+        except Exception as e:
+            # a failed poll is retried on the next due tick
+            logger.warning('poll of %d variables failed: %r', len(items), e)
+            return
+        finally:
+            self.in_flight.difference_update(items)
+        now = time.time()
+        results = dict(zip(items, values))
+        for poll in polls:
+            poll.publish(results[(poll.name, poll.mech_id)], now)
+
+    def poll(self, tick):
+        # a variable that is due in several registrations is read once, and
+        # one whose previous read has not returned yet is skipped
+        due = [poll for poll in self.polls.values() if poll.due(tick)]
+        items = []
+        for poll in due:
+            item = (poll.name, poll.mech_id)
+            if (item not in self.in_flight and item not in items):
+                items.append(item)
+        due = [poll for poll in due if (poll.name, poll.mech_id) in items]
+        for start in range(0, len(items), self.max_batch):
+            batch = items[start:start + self.max_batch]
+            self.in_flight.update(batch)
+            self.requests += 1
+            asyncio.ensure_future(
+                self.request(batch, [
+                    poll for poll in due
+                    if (poll.name, poll.mech_id) in batch
+                ]))
+
+    async def run(self):
+        # ticks are scheduled against absolute time so they do not drift
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        while True:
+            self.poll(self.ticks)
+            self.ticks += 1
+            delay = start + self.ticks * self.tick - loop.time()
+            if (delay > 0):
+                await asyncio.sleep(delay)
+            else:
+                await asyncio.sleep(0)
+
+    def start(self):
+        if (self.task is None):
+            self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    def close(self):
+        if (self.task is not None):
+            self.task.cancel()
+            self.task = None
@@ -0,0 +1,402 @@
+import argparse
+import asyncio
+import random
+import struct
+import numpy as np
+from lxml import etree
+from fulcrane.controller import (ACCESS_CODE_MAP, CYCLE_PERIODS,
+                                 PACKET_MAGIC_NUMBER, FrameDecoder, flex_tag)
+
+PRIORITY_PERIODS = {
+    cycle.value: period
+    for cycle, period in CYCLE_PERIODS.items()
+}
+VALUE_TAGS = {"SYSTEM!": "r", "SYSTEM%": "i", "FI": "b", "FO": "b"}
+ENCODER_SCALE = 1000
+NOTE_MOTOR_ON = 1
+NOTE_MOTOR_OFF = 2
+
+
+def create_frame(xml):
+    return PACKET_MAGIC_NUMBER + struct.pack('<i', len(xml)) + xml
+
+
+def format_values(value_tag, values):
+    if (value_tag == "r"):
+        texts = [repr(float(value)) for value in values]
+    else:
+        texts = [str(int(value)) for value in values]
+    return "".join("<{0}>{1}</{0}>".format(value_tag, text) for text in texts)
+
+
+def create_data_update_xml(data_node, value_tag, values):
+    return ('<?xml version="1.0" encoding="utf-8"?>'
+            '<flexData version="1" xmlns="flex.gui"><dataExchange>'
+            '<dataUpdate><data unit="{}" group="{}" id="{}" subid="{}" '
+            'count="{}">{}</data></dataUpdate></dataExchange></flexData>'
+            ).format(data_node.get("unit"), data_node.get("group"),
+                     data_node.get("id"), data_node.get("subid"),
+                     data_node.get("count"),
+                     format_values(value_tag, values)).encode()
+
+
+def create_update_ack_xml(seqid):
+    return ('<?xml version="1.0" encoding="utf-8"?>'
+            '<flexData version="1" xmlns="flex.gui"><dataExchange>'
+            '<dataUpdateAck seqid="{}"/></dataExchange></flexData>'
+            ).format(seqid).encode()
+
+
+def create_command_result_xml(command_name, sequid, result, result_text):
+    return ('<?xml version="1.0" encoding="utf-8"?>'
+            '<flexData version="1" xmlns="flex.gui"><operations>'
+            '<commandResult name="{}" sequid="{}"><result>{}</result>'
+            '<resultText>{}</resultText></commandResult></operations>'
+            '</flexData>').format(command_name, sequid, result,
+                                  result_text).encode()
+
+
+def create_notification_xml(code, mech_id, message):
+    return ('<?xml version="1.0" encoding="utf-8"?>'
+            '<flexData version="1" xmlns="flex.gui"><notifications><note>'
+            '<code>{}</code><mech>{}</mech><message>{}</message>'
+            '<content></content><measures></measures></note>'
+            '</notifications></flexData>').format(code, mech_id,
+                                                  message).encode()
+
+
+class SimulatedLink(object):
+    # delays outgoing frames by latency + jitter (never reordering them) and
+    # optionally re-chunks the byte stream so frames are split and coalesced
+    # the way TCP delivers them
+    def __init__(self, transport, latency, jitter, max_chunk, rng):
+        self.transport = transport
+        self.latency = latency
+        self.jitter = jitter
+        self.max_chunk = max_chunk
+        self.rng = rng
+        self.last_due = 0.0
+        self.pending = bytearray()
+        self.flush_handle = None
+
+    def send(self, frame):
+        loop = asyncio.get_running_loop()
+        if (self.latency <= 0 and self.jitter <= 0):
+            self.deliver(frame)
+            return
+        delay = self.latency + self.rng.uniform(0, self.jitter)
+        due = max(self.last_due, loop.time() + delay)
+        self.last_due = due
+        loop.call_at(due, self.deliver, frame)
+
+    def deliver(self, frame):
+        if (self.transport.is_closing()):
+            return
+        if (self.max_chunk is None):
+            self.transport.write(frame)
+            return
+        self.pending += frame
+        while True:
+            size = self.rng.randint(1, self.max_chunk)
+            if (size > len(self.pending)):
+                break
+            self.transport.write(bytes(self.pending[:size]))
+            del self.pending[:size]
+        if (len(self.pending) > 0 and self.flush_handle is None):
+            self.flush_handle = asyncio.get_running_loop().call_later(
+                0.001, self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+        if (len(self.pending) > 0 and not self.transport.is_closing()):
+            self.transport.write(bytes(self.pending))
+        self.pending.clear()
+
+
+class PushSubscription(object):
+    def __init__(self, data_node, period, threshold):
+        self.data_node = data_node
+        self.period = period
+        self.threshold = threshold
+        self.next_due = 0.0
+        self.last_values = None
+
+
+class SimulatorProtocol(asyncio.Protocol):
+    def __init__(self, arm):
+        self.arm = arm
+        self.decoder = FrameDecoder(self.dispatch)
+        self.subscriptions = {}
+        self.link = None
+
+    def connection_made(self, transport):
+        simulator = self.arm.simulator
+        self.link = SimulatedLink(transport, simulator.latency,
+                                  simulator.jitter, simulator.max_chunk,
+                                  simulator.rng)
+        self.arm.connections.append(self)
+
+    def connection_lost(self, exc):
+        self.arm.connections.remove(self)
+
+    def data_received(self, data):
+        self.decoder.feed(data)
+
+    def send(self, xml):
+        self.link.send(create_frame(xml))
+
+    def dispatch(self, frame):
+        element = etree.fromstring(frame)
+        for data_node in element.iter(flex_tag("data")):
+            parent = data_node.getparent()
+            if (parent.tag == flex_tag("dataRequest")):
+                self.request(data_node)
+            elif (parent.tag == flex_tag("dataUpdate")):
+                self.arm.write(data_node.get("group"), data_node.get("id"),
+                               int(data_node.get("subid")), data_node[0].text)
+                self.send(create_update_ack_xml(parent.get("seqid")))
+        for command_node in element.iter(flex_tag("command")):
+            params = [(node.get("name"), node.text)
+                      for node in command_node.iter(flex_tag("param"))]
+            result, result_text = self.arm.execute(command_node.get("name"),
+                                                   params)
+            self.send(
+                create_command_result_xml(command_node.get("name"),
+                                          command_node.get("sequid"), result,
+                                          result_text))
+
+    def request(self, data_node):
+        if (data_node.get("push") != "1"):
+            self.send(self.read(data_node))
+            return
+        key = (data_node.get("unit"), data_node.get("group"),
+               data_node.get("id"), data_node.get("subid"))
+        period = PRIORITY_PERIODS.get(int(data_node.get("priority")), 0.5)
+        self.subscriptions[key] = PushSubscription(
+            data_node, period, float(data_node.get("threshold")))
+
+    def read(self, data_node, subscription=None):
+        value_tag, values = self.arm.read(data_node.get("group"),
+                                          data_node.get("id"),
+                                          int(data_node.get("subid")),
+                                          int(data_node.get("count")))
+        if (subscription is not None):
+            # like the controller, a push is only sent once the value moved
+            # by at least the requested threshold
+            last = subscription.last_values
+            if (last is not None and
+                    np.max(np.abs(values - last)) < subscription.threshold):
+                return None
+            subscription.last_values = values
+        return create_data_update_xml(data_node, value_tag, values)
+
+    def push(self, now):
+        # a tick that lands just before the due time still counts, otherwise
+        # timer granularity would halve the rate of at5ms pushes
+        slack = self.arm.simulator.dt / 2
+        for subscription in self.subscriptions.values():
+            if (now + slack < subscription.next_due):
+                continue
+            subscription.next_due = max(subscription.next_due +
+                                        subscription.period, now)
+            xml = self.read(subscription.data_node, subscription)
+            if (xml is not None):
+                self.send(xml)
+
+
+class VirtualArm(object):
+    def __init__(self, simulator, index):
+        self.simulator = simulator
+        self.index = index
+        self.connections = []
+        self.server = None
+        self.port = None
+
+    def read(self, group, request_id, subid, count):
+        s = self.simulator
+        i = self.index
+        variables = {
+            ACCESS_CODE_MAP['AcsToolTipPos']: s.pose[i],
+            ACCESS_CODE_MAP['AcsTcpSpeed']: s.pose_velocity[i],
+            ACCESS_CODE_MAP['AcsAxisEncode']: s.joint[i] * ENCODER_SCALE,
+            ACCESS_CODE_MAP['AcsAxisTheta']: s.joint[i],
+            ACCESS_CODE_MAP['AcsAxisSpeed']: s.joint_velocity[i],
+            ACCESS_CODE_MAP['AcsAxisOrderSpped']: s.joint_velocity[i],
+            ACCESS_CODE_MAP['AcsFixedIOPlayback']: [1],
+            ACCESS_CODE_MAP['AcsServoMotorOnOff']: [s.motor_on[i]],
+            ACCESS_CODE_MAP['AcsFixedIOConfirmMotorsOn']: [s.motor_on[i]],
+            ACCESS_CODE_MAP['AcsFixedIOStartDisplay1']: [s.moving[i]],
+            ACCESS_CODE_MAP['AcsFixedIOMotorsOnLAMP']: [s.motor_on[i]],
+            ACCESS_CODE_MAP['AcsStatusSavingEnergy']: [0],
+            ACCESS_CODE_MAP['AcsAxisAmpValue']: s.current[i],
+            ACCESS_CODE_MAP['AcsInterpolationKind']: [s.interpolation[i]]
+        }
+        values = variables.get((group, request_id, subid), np.zeros(count))
+        return (VALUE_TAGS.get(request_id, "i"),
+                np.array(values, dtype=np.float64)[:count])
+
+    def write(self, group, request_id, subid, text):
+        variable = (group, request_id, subid)
+        if (variable == ACCESS_CODE_MAP['AcsInterpolationKind']):
+            self.simulator.interpolation[self.index] = int(text)
+
+    def execute(self, command_name, params):
+        s = self.simulator
+        i = self.index
+        values = np.array([float(value) for (_, value) in params[:6]
+                           if value is not None])
+        if (command_name in ("MoveJ", "MoveJA", "MoveX", "MoveXR")
+                and not s.motor_on[i]):
+            return 0, "motor off"
+        if (command_name == "MoveJ"):
+            s.joint_target[i] = values
+        elif (command_name == "MoveJA"):
+            s.joint_target[i] += values
+        elif (command_name == "MoveX"):
+            s.pose_target[i] = values
+        elif (command_name == "MoveXR"):
+            s.pose_target[i] += values
+        elif (command_name == "selectMotorOn"):
+            if (params[0][1] == "1" and not s.motor_on[i]):
+                s.motor_on[i] = True
+                self.notify(NOTE_MOTOR_ON, "motors on")
+        elif (command_name == "selectMotorOff"):
+            if (s.motor_on[i]):
+                s.motor_on[i] = False
+                self.notify(NOTE_MOTOR_OFF, "motors off")
+        else:
+            return 0, "unknown command"
+        return 1, "OK"
+
+    def notify(self, code, message, mech_id=1):
+        for connection in self.connections:
+            connection.send(create_notification_xml(code, mech_id, message))
+
+
+class Simulator(object):
+    @classmethod
+    async def create(cls,
+                     arms=1,
+                     host='127.0.0.1',
+                     port=0,
+                     latency=0.0,
+                     jitter=0.0,
+                     max_chunk=None,
+                     joint_speed=60.0,
+                     linear_speed=250.0,
+                     idle_current=0.3,
+                     current_gain=0.01,
+                     current_time_constant=0.05,
+                     dt=0.005,
+                     seed=None):
+        # one process, one tick task and one set of (arms, 6) state arrays
+        # for every virtual arm; each arm listens on its own port
+        self = cls()
+        loop = asyncio.get_running_loop()
+        self.latency = latency
+        self.jitter = jitter
+        self.max_chunk = max_chunk
+        self.joint_speed = joint_speed
+        self.linear_speed = linear_speed
+        self.idle_current = idle_current
+        self.current_gain = current_gain
+        self.current_time_constant = current_time_constant
+        self.dt = dt
+        self.rng = random.Random(seed)
+        self.joint = np.zeros((arms, 6))
+        self.joint_target = np.zeros((arms, 6))
+        self.joint_velocity = np.zeros((arms, 6))
+        self.pose = np.zeros((arms, 6))
+        self.pose_target = np.zeros((arms, 6))
+        self.pose_velocity = np.zeros((arms, 6))
+        self.current = np.zeros((arms, 6))
+        self.motor_on = np.zeros(arms, dtype=bool)
+        self.moving = np.zeros(arms, dtype=bool)
+        self.interpolation = np.zeros(arms, dtype=int)
+        self.arms = [VirtualArm(self, i) for i in range(arms)]
+        for arm in self.arms:
+            arm.server = await loop.create_server(
+                lambda arm=arm: SimulatorProtocol(arm), host,
+                0 if port == 0 else port + arm.index)
+            arm.port = arm.server.sockets[0].getsockname()[1]
+        self.last_tick = loop.time()
+        self.task = asyncio.ensure_future(self.run())
+        return self
+
+    @property
+    def ports(self):
+        return [arm.port for arm in self.arms]
+
+    def integrate(self, position, target, velocity, max_speed, elapsed):
+        step = np.clip(target - position, -max_speed * elapsed,
+                       max_speed * elapsed)
+        step *= self.motor_on[:, None]
+        velocity[:] = step / elapsed
+        position += step
+
+    def step(self, elapsed):
+        self.integrate(self.joint, self.joint_target, self.joint_velocity,
+                       self.joint_speed, elapsed)
+        self.integrate(self.pose, self.pose_target, self.pose_velocity,
+                       self.linear_speed, elapsed)
+        self.moving = (np.any(self.joint_velocity != 0, axis=1)
+                       | np.any(self.pose_velocity != 0, axis=1))
+        target_current = self.motor_on[:, None] * (
+            self.idle_current +
+            self.current_gain * np.abs(self.joint_velocity))
+        self.current += (target_current - self.current) * min(
+            1.0, elapsed / self.current_time_constant)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            next_tick += self.dt
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            now = loop.time()
+            if (now - next_tick > self.dt):
+                next_tick = now  # fell behind, skip ticks instead of bursting
+            self.step(max(now - self.last_tick, 1e-6))
+            self.last_tick = now
+            for arm in self.arms:
+                for connection in arm.connections:
+                    connection.push(now)
+
+    async def close(self):
+        self.task.cancel()
+        for arm in self.arms:
+            arm.server.close()
+            for connection in list(arm.connections):
+                connection.link.transport.close()
+        for arm in self.arms:
+            await arm.server.wait_closed()
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="fulcrane controller simulator")
+    parser.add_argument('--arms', type=int, default=1)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9876)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--max-chunk', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    simulator = await Simulator.create(arms=args.arms,
+                                       host=args.host,
+                                       port=args.port,
+                                       latency=args.latency,
+                                       jitter=args.jitter,
+                                       max_chunk=args.max_chunk,
+                                       seed=args.seed)
+    print("simulating {} arm(s) on ports {}-{}".format(
+        args.arms, simulator.ports[0], simulator.ports[-1]))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await simulator.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
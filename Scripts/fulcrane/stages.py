@@ -0,0 +1,109 @@
+import math
+import time
+import numpy as np
+
+# stages take (values, now) and return the values to pass on, or None to
+# drop the sample; a Pipeline runs them in order in front of a callback
+
+
+class Decimate(object):
+    # passes at most rate samples per second, on a fixed grid so the output
+    # rate does not drift with the arrival jitter
+    def __init__(self, rate):
+        self.period = 1.0 / rate
+        self.next = None
+
+    def __call__(self, values, now):
+        if (self.next is not None and now < self.next):
+            return None
+        if (self.next is None or now - self.next >= self.period):
+            self.next = now + self.period
+        else:
+            self.next += self.period
+        return values
+
+
+class Deadband(object):
+    # passes a sample only when some axis moved more than width (scalar or
+    # per axis) away from the last sample passed on
+    def __init__(self, width):
+        self.width = np.asarray(width, dtype=np.float64)
+        self.last = None
+
+    def __call__(self, values, now):
+        if (self.last is not None
+                and not np.any(np.abs(values - self.last) > self.width)):
+            return None
+        self.last = np.array(values, dtype=np.float64)
+        return values
+
+
+class MovingAverage(object):
+    def __init__(self, window):
+        self.window = window
+        self.samples = None
+        self.total = None
+        self.count = 0
+
+    def __call__(self, values, now):
+        values = np.asarray(values, dtype=np.float64)
+        if (self.samples is None):
+            self.samples = np.zeros((self.window, ) + values.shape)
+            self.total = np.zeros(values.shape)
+        index = self.count % self.window
+        if (self.count >= self.window):
+            self.total -= self.samples[index]
+        self.samples[index] = values
+        self.total += values
+        self.count += 1
+        return self.total / min(self.count, self.window)
+
+
+def smoothing_factor(dt, cutoff):
+    tau = 1.0 / (2.0 * math.pi * cutoff)
+    return 1.0 / (1.0 + tau / dt)
+
+
+class OneEuro(object):
+    # Casiez et al.: a low-pass filter whose cutoff rises with the speed of
+    # the signal, so slow motion is smoothed and fast motion lags little
+    def __init__(self, min_cutoff=1.0, beta=0.0, derivative_cutoff=1.0):
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.derivative_cutoff = derivative_cutoff
+        self.value = None
+        self.derivative = None
+        self.last = None
+
+    def __call__(self, values, now):
+        values = np.asarray(values, dtype=np.float64)
+        if (self.value is None):
+            self.value = values.copy()
+            self.derivative = np.zeros(values.shape)
+            self.last = now
+            return self.value.copy()
+        dt = now - self.last
+        if (dt <= 0.0):
+            return self.value.copy()
+        self.last = now
+        a = smoothing_factor(dt, self.derivative_cutoff)
+        self.derivative += a * ((values - self.value) / dt - self.derivative)
+        cutoff = self.min_cutoff + self.beta * np.abs(self.derivative)
+        a = smoothing_factor(dt, cutoff)
+        self.value += a * (values - self.value)
+        return self.value.copy()
+
+
+class Pipeline(object):
+    def __init__(self, stages, callback, clock=time.monotonic):
+        self.stages = list(stages)
+        self.callback = callback
+        self.clock = clock
+
+    def __call__(self, values):
+        now = self.clock()
+        for stage in self.stages:
+            values = stage(values, now)
+            if (values is None):
+                return None
+        return self.callback(values)
@@ -0,0 +1,100 @@
+import bisect
+import numpy as np
+
+# 8 buckets per decade from 1 us to 10 s
+DEFAULT_EDGES = np.logspace(-6, 1, 57)
+
+
+class Histogram(object):
+    def __init__(self, edges=DEFAULT_EDGES):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.edge_list = self.edges.tolist()
+        self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def record(self, value):
+        self.counts[bisect.bisect_right(self.edge_list, value)] += 1
+        self.count += 1
+        self.total += value
+        if (value < self.min):
+            self.min = value
+        if (value > self.max):
+            self.max = value
+
+    def percentile(self, q):
+        # upper edge of the bucket holding the q-th percentile
+        if (self.count == 0):
+            return None
+        index = int(
+            np.searchsorted(np.cumsum(self.counts), q / 100.0 * self.count))
+        if (index >= len(self.edges)):
+            return self.max
+        return min(float(self.edges[index]), self.max)
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count > 0 else None,
+            "min": self.min if self.count > 0 else None,
+            "max": self.max if self.count > 0 else None,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "edges": self.edge_list,
+            "counts": self.counts.tolist()
+        }
+
+
+class ConnectionStats(object):
+    def __init__(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+        self.timeouts = 0
+        self.orphaned_replies = 0
+        self.parse_time = Histogram()
+        self.round_trip = {}
+        self.jitter = {}
+        self.periods = {}
+        self.last_arrival = {}
+
+    def record_round_trip(self, key, elapsed):
+        if (key not in self.round_trip):
+            self.round_trip[key] = Histogram()
+        self.round_trip[key].record(elapsed)
+
+    def set_period(self, key, period):
+        self.periods[key] = period
+        if (key not in self.jitter):
+            self.jitter[key] = Histogram()
+
+    def record_arrival(self, key, now):
+        # deviation of the inter-arrival time from the requested cycle
+        period = self.periods.get(key)
+        last = self.last_arrival.get(key)
+        self.last_arrival[key] = now
+        if (period is not None and last is not None):
+            self.jitter[key].record(abs(now - last - period))
+
+    def snapshot(self):
+        return {
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "frames_in": self.frames_in,
+            "frames_out": self.frames_out,
+            "timeouts": self.timeouts,
+            "orphaned_replies": self.orphaned_replies,
+            "parse_time": self.parse_time.snapshot(),
+            "round_trip": {
+                key: histogram.snapshot()
+                for key, histogram in self.round_trip.items()
+            },
+            "jitter": {
+                key: histogram.snapshot()
+                for key, histogram in self.jitter.items()
+            }
+        }
@@ -0,0 +1,104 @@
+import asyncio
+import time
+import numpy as np
+from fulcrane.controller import ACCESS_CODE_MAP, MIN_THRESHOLD, MonitorCycle
+
+
+def create_record_dtype(width):
+    return np.dtype([('timestamp', '<f8'), ('values', '<f4', (width, ))])
+
+
+def load(path, width=6):
+    # recordings are raw little-endian records, so they map without copying
+    return np.memmap(path, dtype=create_record_dtype(width), mode='r')
+
+
+class TelemetryRecorder(object):
+    def __init__(self,
+                 path,
+                 width=6,
+                 capacity=8192,
+                 flush_interval=0.5,
+                 clock=time.time):
+        self.path = path
+        self.width = width
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.samples = np.zeros(capacity, dtype=create_record_dtype(width))
+        self.timestamps = self.samples['timestamp']
+        self.values = self.samples['values']
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+        self.file = open(path, 'ab')
+        self.task = None
+        self.writing = None
+
+    def record(self, values):
+        # samples that arrive while the buffer is full of unflushed data are
+        # counted and dropped rather than overwriting what is not on disk yet
+        if (self.head - self.tail >= self.capacity):
+            self.dropped += 1
+            return False
+        index = self.head % self.capacity
+        self.timestamps[index] = self.clock()
+        self.values[index] = values
+        self.head += 1
+        return False
+
+    __call__ = record
+
+    def take_chunk(self):
+        start = self.tail % self.capacity
+        end = start + (self.head - self.tail)
+        if (end <= self.capacity):
+            chunk = self.samples[start:end].tobytes()
+        else:
+            chunk = (self.samples[start:].tobytes() +
+                     self.samples[:end - self.capacity].tobytes())
+        self.tail = self.head
+        return chunk
+
+    def flush(self):
+        self.file.write(self.take_chunk())
+        self.file.flush()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if (self.head == self.tail):
+                continue
+            chunk = self.take_chunk()
+            self.writing = loop.run_in_executor(None, self.file.write, chunk)
+            await asyncio.shield(self.writing)
+
+    def start(self):
+        if (self.task is None):
+            self.task = asyncio.ensure_future(self.run())
+        return self
+
+    async def subscribe(self,
+                        controller,
+                        name,
+                        mech_id=1,
+                        cycle=MonitorCycle.at5ms,
+                        threshold=MIN_THRESHOLD):
+        self.start()
+        return await controller.monitor(*ACCESS_CODE_MAP[name], self.record,
+                                        mech_id, cycle, threshold)
+
+    async def close(self):
+        if (self.task is not None):
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if (self.writing is not None):
+            await self.writing
+            self.writing = None
+        self.flush()
+        self.file.close()
@@ -0,0 +1,191 @@
+import time
+from collections import deque
+import numpy as np
+from fulcrane.controller import ACCESS_CODE_MAP, CYCLE_PERIODS, MonitorCycle
+
+# all times are host time.monotonic() seconds
+
+
+class SampleClock(object):
+    # the controller pushes a subscription on a fixed grid of its own clock,
+    # so arrival - index * period is the grid origin plus the network delay.
+    # The lower envelope of that residual over a sliding window is the
+    # origin plus the minimum delay; what lies above it is transport jitter.
+    # Subtracting the minimum one-way delay, estimated as half the best round
+    # trip, maps each sample to the host time at which it was taken
+    def __init__(self, period, window=2.0, smoothing=0.05):
+        self.period = period
+        self.window = window
+        self.smoothing = smoothing
+        self.index = -1
+        self.last_arrival = None
+        self.envelope = deque()
+        self.offset = None
+        self.jitter = 0.0
+        self.delay = 0.0
+
+    def record_round_trip(self, elapsed):
+        delay = elapsed / 2.0
+        if (self.delay == 0.0 or delay < self.delay):
+            self.delay = delay
+        else:
+            self.delay += self.smoothing * (delay - self.delay)
+
+    def sample_index(self, arrival):
+        # samples suppressed by the threshold leave gaps in the grid, and
+        # samples received in one chunk still need distinct indices
+        gap = round((arrival - self.offset - self.jitter) / self.period -
+                    self.index)
+        return self.index + max(1, gap)
+
+    def update(self, arrival):
+        # returns the host time at which the sample arriving now was taken
+        if (self.last_arrival is None):
+            self.index = 0
+        else:
+            self.index = self.sample_index(arrival)
+        self.last_arrival = arrival
+        residual = arrival - self.index * self.period
+        # monotonic deque: the sliding window minimum in O(1) per sample
+        while (self.envelope and self.envelope[-1][1] >= residual):
+            self.envelope.pop()
+        self.envelope.append((arrival, residual))
+        while (self.envelope[0][0] < arrival - self.window):
+            self.envelope.popleft()
+        minimum = self.envelope[0][1]
+        if (self.offset is None or minimum < self.offset):
+            self.offset = minimum
+        else:
+            self.offset += self.smoothing * (minimum - self.offset)
+        self.jitter += self.smoothing * (residual - self.offset - self.jitter)
+        return self.offset + self.index * self.period - self.delay
+
+
+class Predictor(object):
+    # ring buffer of timestamped samples, interpolated inside the buffer and
+    # extrapolated past its end by a least squares line through the newest
+    # fit samples. Axes flagged in wrap are angles in degrees that are
+    # unwrapped before fitting
+    def __init__(self,
+                 width=6,
+                 size=64,
+                 fit=4,
+                 max_extrapolation=0.1,
+                 wrap=None):
+        self.times = np.zeros(size)
+        self.values = np.zeros((size, width))
+        self.size = size
+        self.fit = fit
+        self.max_extrapolation = max_extrapolation
+        self.wrap = (np.zeros(width, dtype=bool)
+                     if wrap is None else np.asarray(wrap, dtype=bool))
+        self.count = 0
+
+    def add(self, timestamp, values):
+        index = self.count % self.size
+        self.times[index] = timestamp
+        self.values[index] = values
+        self.count += 1
+
+    def recent(self, n):
+        n = min(n, self.count, self.size)
+        indices = np.arange(self.count - n, self.count) % self.size
+        times = self.times[indices]
+        values = self.values[indices]
+        if (self.wrap.any()):
+            values[:, self.wrap] = np.unwrap(values[:, self.wrap],
+                                             period=360.0,
+                                             axis=0)
+        return times, values
+
+    def predict(self, t):
+        if (self.count == 0):
+            return None
+        last = self.times[(self.count - 1) % self.size]
+        if (t < last):
+            times, values = self.recent(self.size)
+            result = np.array([
+                np.interp(t, times, values[:, axis])
+                for axis in range(values.shape[1])
+            ])
+        else:
+            times, values = self.recent(self.fit)
+            result = values[-1].copy()
+            if (len(times) > 1 and times[-1] > times[0]):
+                # extrapolation is capped so a stream that stopped updating
+                # is not run off along its last slope
+                dt = min(t - last, self.max_extrapolation)
+                x = times - last
+                dx = x - x.mean()
+                mean = values.mean(axis=0)
+                slope = ((dx[:, None] * (values - mean)).sum(axis=0) /
+                         (dx * dx).sum())
+                result = mean + slope * (dt - x.mean())
+        result[self.wrap] = (result[self.wrap] + 180.0) % 360.0 - 180.0
+        return result
+
+
+class PoseTracker(object):
+    # timestamps joint angles and tool pose at arrival, aligns them to the
+    # controller's sampling grid and predicts either at any host time
+    @classmethod
+    async def create(cls,
+                     controller,
+                     names=("AcsAxisTheta", "AcsToolTipPos"),
+                     mech_id=1,
+                     cycle=MonitorCycle.at5ms,
+                     threshold=0.0,
+                     calibration=8,
+                     **options):
+        # options are passed on to every Predictor; the r, p, y axes of
+        # AcsToolTipPos are always unwrapped
+        self = cls()
+        self.controller = controller
+        self.period = CYCLE_PERIODS[cycle]
+        self.clocks = {}
+        self.predictors = {}
+        self.subscriptions = []
+        for name in names:
+            wrap = ([False] * 3 + [True] * 3
+                    if name == "AcsToolTipPos" else None)
+            self.clocks[name] = SampleClock(self.period)
+            self.predictors[name] = Predictor(wrap=wrap, **options)
+        await self.calibrate(calibration, mech_id)
+        for name in names:
+            self.subscriptions.append(await controller.monitor(
+                *ACCESS_CODE_MAP[name], self.create_callback(name), mech_id,
+                cycle, threshold))
+        return self
+
+    async def calibrate(self, count, mech_id=1):
+        # the one-way delay comes from the best of a few pulls
+        for _ in range(count):
+            start = time.monotonic()
+            await self.controller.get_joint_angle(mech_id)
+            elapsed = time.monotonic() - start
+            for clock in self.clocks.values():
+                clock.record_round_trip(elapsed)
+
+    def create_callback(self, name):
+        clock = self.clocks[name]
+        predictor = self.predictors[name]
+
+        def callback(values):
+            predictor.add(clock.update(self.controller.arrival), values)
+
+        return callback
+
+    def predict(self, name, t=None):
+        return self.predictors[name].predict(
+            time.monotonic() if t is None else t)
+
+    def joint_angle(self, t=None):
+        return self.predict("AcsAxisTheta", t)
+
+    def pose(self, t=None):
+        return self.predict("AcsToolTipPos", t)
+
+    def close(self):
+        for subscription in self.subscriptions:
+            subscription.close()
+        self.subscriptions = []
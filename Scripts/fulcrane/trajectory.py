@@ -0,0 +1,160 @@
+import numpy as np
+from numpy import linalg as LA
+from fulcrane.controller import MIN_THRESHOLD
+
+
+def segment_lengths(points):
+    return LA.norm(np.diff(points, axis=0), axis=1)
+
+
+def find_far_point(points, start, first, tolerance, block=64):
+    # first index from first on that is at least tolerance away from
+    # points[start], searched in growing blocks
+    while (first < len(points)):
+        far = np.flatnonzero(
+            LA.norm(points[first:first + block] - points[start], axis=1) >=
+            tolerance)
+        if (len(far) > 0):
+            return first + far[0]
+        first += block
+        block *= 2
+    return None
+
+
+def follow(jumps, start):
+    # start and its successors up to the sentinel, by pointer doubling;
+    # jumps[k] maps an index to its 2**k-th successor and grows as needed
+    sentinel = len(jumps[0]) - 1
+    chain = np.array([start])
+    level = 0
+    while (chain[-1] != sentinel):
+        if (level == len(jumps)):
+            jumps.append(jumps[-1][jumps[-1]])
+        chain = np.concatenate((chain, jumps[level][chain]))
+        level += 1
+    return chain[:np.argmax(chain == sentinel)]
+
+
+def deduplicate(points, tolerance=MIN_THRESHOLD):
+    # drops every point closer than tolerance to the last point kept, so a
+    # dense path of small steps is thinned rather than collapsed. The last
+    # point always ends the path and replaces a kept point too close to it.
+    # No point nearer than tolerance along the path can be far enough away,
+    # so the first one past that path length is the next point kept
+    # whenever it is itself far enough, which holds on all but sharply
+    # turning paths; only there are the following points searched
+    points = np.asarray(points, dtype=np.float64)
+    if (len(points) < 2):
+        return points
+    count = len(points)
+    distance = np.concatenate(([0.0], np.cumsum(segment_lengths(points))))
+    # rounding in the running sum must not skip a point that is far enough
+    slack = 4 * count * np.finfo(np.float64).eps * distance[-1]
+    following = np.maximum(
+        np.searchsorted(distance, distance + tolerance - slack),
+        np.arange(1, count + 1))
+    candidate = np.minimum(following, count - 1)
+    far = (following < count) & (LA.norm(points[candidate] - points, axis=1)
+                                 >= tolerance)
+    jumps = [np.append(np.where(far, following, count), count)]
+    chains = []
+    start = 0
+    while (start is not None):
+        chain = follow(jumps, start)
+        chains.append(chain)
+        end = chain[-1]
+        if (following[end] >= count):
+            break
+        start = find_far_point(points, end, following[end] + 1, tolerance)
+    keep = np.concatenate(chains)
+    if (keep[-1] != count - 1):
+        if (LA.norm(points[-1] - points[keep[-1]]) < tolerance):
+            if (len(keep) == 1):
+                return points[keep]
+            keep = keep[:-1]
+        keep = np.append(keep, count - 1)
+    return points[keep]
+
+
+def repeated(points):
+    # np.interp needs a strictly increasing parameter, so points that
+    # repeat their predecessor are masked out
+    return np.concatenate(([False], segment_lengths(points) == 0))
+
+
+def interpolate(points, parameter, targets):
+    columns = [
+        np.interp(targets, parameter, points[:, axis])
+        for axis in range(points.shape[1])
+    ]
+    return np.stack(columns, axis=1)
+
+
+def resample(points, spacing):
+    # uniform spacing along the arc length of the path; near duplicates are
+    # left to deduplicate, which prepare runs with the caller's tolerance
+    points = np.asarray(points, dtype=np.float64)
+    points = points[~repeated(points)]
+    if (len(points) < 2):
+        return points
+    distance = np.concatenate(([0.0], np.cumsum(segment_lengths(points))))
+    targets = np.arange(0.0, distance[-1], spacing)
+    if (distance[-1] - targets[-1] < spacing * 0.5 and len(targets) > 1):
+        targets = targets[:-1]
+    return interpolate(points, distance, np.append(targets, distance[-1]))
+
+
+def resample_by_velocity(points, velocity, period):
+    # velocity is a scalar or one value per input point; the path is sampled
+    # every `period` seconds of the resulting timing law
+    points = np.asarray(points, dtype=np.float64)
+    velocity = np.broadcast_to(np.asarray(velocity, dtype=np.float64),
+                               (len(points), ))
+    kept = ~repeated(points)
+    points = points[kept]
+    velocity = velocity[kept]
+    if (len(points) < 2):
+        return points
+    segment_velocity = 0.5 * (velocity[:-1] + velocity[1:])
+    if (np.any(segment_velocity <= 0)):
+        raise ValueError("velocity must be positive")
+    time = np.concatenate(
+        ([0.0], np.cumsum(segment_lengths(points) / segment_velocity)))
+    targets = np.arange(0.0, time[-1], period)
+    return interpolate(points, time, np.append(targets, time[-1]))
+
+
+def within_limits(points, lower, upper):
+    points = np.asarray(points)
+    return np.all((points >= lower) & (points <= upper), axis=1)
+
+
+def check_limits(points, lower, upper, max_step=None):
+    points = np.asarray(points)
+    inside = within_limits(points, lower, upper)
+    if (not np.all(inside)):
+        index = int(np.argmin(inside))
+        raise ValueError("point {} out of limits: {}".format(
+            index, points[index]))
+    if (max_step is not None and len(points) > 1):
+        steps = np.abs(np.diff(points, axis=0)) > max_step
+        if (np.any(steps)):
+            index = int(np.argmax(np.any(steps, axis=1))) + 1
+            raise ValueError("step to point {} exceeds max_step: {}".format(
+                index, points[index]))
+    return points
+
+
+def prepare(points,
+            tolerance=MIN_THRESHOLD,
+            spacing=None,
+            lower=None,
+            upper=None,
+            max_step=None):
+    points = deduplicate(points, tolerance)
+    if (spacing is not None):
+        points = resample(points, spacing)
+    if (lower is not None or upper is not None):
+        check_limits(points, -np.inf if lower is None else lower,
+                     np.inf if upper is None else upper, max_step)
+    return points.astype(np.float32)
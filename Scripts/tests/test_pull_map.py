@@ -0,0 +1,144 @@
+import asyncio
+import time
+import numpy as np
+import pytest
+from fulcrane.controller import Controller
+from fulcrane.simulator import Simulator
+
+# request/reply matching on the control connection, run against the
+# simulator: python -m pytest tests
+
+
+def run(test, latency=0.0, **options):
+    async def main():
+        simulator = await Simulator.create(arms=1, latency=latency)
+        controller = await Controller.create('127.0.0.1',
+                                             simulator.ports[0],
+                                             stats=True,
+                                             **options)
+        try:
+            await test(simulator, controller)
+        finally:
+            controller.close()
+            await simulator.close()
+
+    asyncio.run(main())
+
+
+def outstanding(controller):
+    return sum(
+        sum(not isinstance(slot, float) for slot in futs)
+        for futs in controller.pull_map.values())
+
+
+def test_late_reply_is_absorbed_by_its_timed_out_slot():
+    async def test(simulator, controller):
+        with pytest.raises(asyncio.TimeoutError):
+            await controller.get_joint_angle(timeout=0.05)
+        simulator.joint[0] = 42.0
+        values = await controller.get_joint_angle(timeout=2.0)
+        assert np.all(values == 42.0)
+        assert controller.statistics.orphaned_replies == 1
+        assert controller.pull_map == {}
+        assert np.all(await controller.get_joint_angle(max_age=10.0) == 42.0)
+
+    run(test, latency=0.2)
+
+
+def test_lost_reply_costs_at_most_one_more_timeout():
+    async def test(simulator, controller):
+        decoder = controller.protocol.decoder
+        dispatch = decoder.on_frame
+        decoder.on_frame = lambda frame: None
+        with pytest.raises(asyncio.TimeoutError):
+            await controller.get_joint_angle(timeout=0.05)
+        decoder.on_frame = dispatch
+        # the drain slot left by the lost reply takes this one's reply
+        with pytest.raises(asyncio.TimeoutError):
+            await controller.get_joint_angle(timeout=0.05)
+        simulator.joint[0] = 7.0
+        for _ in range(3):
+            assert np.all(await controller.get_joint_angle(timeout=1.0) == 7.0)
+        assert controller.pull_map == {}
+        assert controller.behind_drain == set()
+
+    run(test)
+
+
+def test_cancelled_request_absorbs_its_reply_and_frees_its_slot():
+    async def test(simulator, controller):
+        task = asyncio.ensure_future(controller.get_joint_angle(timeout=5.0))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert controller.in_flight._value == controller.max_in_flight
+        simulator.joint[0] = 3.0
+        assert np.all(await controller.get_joint_angle(timeout=2.0) == 3.0)
+        assert controller.statistics.orphaned_replies == 1
+
+    run(test, latency=0.2)
+
+
+def test_max_in_flight_bounds_outstanding_requests():
+    async def test(simulator, controller):
+        peak = 0
+        post_payload = controller.post_payload
+
+        def counting(keys, payload):
+            nonlocal peak
+            futs = post_payload(keys, payload)
+            peak = max(peak, outstanding(controller))
+            return futs
+
+        controller.post_payload = counting
+        start = time.monotonic()
+        await asyncio.gather(
+            *[controller.get_joint_angle(timeout=2.0) for _ in range(6)])
+        assert peak == 2
+        assert time.monotonic() - start >= 0.3
+        # the wait for a slot counts against the timeout
+        blocker = asyncio.ensure_future(
+            asyncio.gather(controller.get_joint_angle(timeout=2.0),
+                           controller.get_position(timeout=2.0)))
+        await asyncio.sleep(0)
+        start = time.monotonic()
+        with pytest.raises(asyncio.TimeoutError):
+            await controller.get_velocity(timeout=0.05)
+        assert time.monotonic() - start < 0.1
+        await blocker
+        assert controller.in_flight._value == 2
+
+    run(test, latency=0.1, max_in_flight=2)
+
+
+def test_stream_trajectory_shares_max_in_flight():
+    async def test(simulator, controller):
+        simulator.motor_on[:] = True
+        with pytest.raises(ValueError):
+            await controller.stream_trajectory(np.zeros((2, 6)), window=5)
+        peak = 0
+        post_payload = controller.post_payload
+
+        def counting(keys, payload):
+            nonlocal peak
+            futs = post_payload(keys, payload)
+            peak = max(peak, outstanding(controller))
+            return futs
+
+        controller.post_payload = counting
+        points = np.linspace(0.0, 10.0, 12)[:, None] * np.ones(6)
+        progress = []
+        results = await asyncio.gather(
+            controller.stream_trajectory(
+                points,
+                window=4,
+                progress=lambda i, result: progress.append(i)),
+            *[controller.get_joint_angle(timeout=2.0) for _ in range(4)])
+        assert len(results[0]) == len(points)
+        assert progress == list(range(len(points)))
+        assert peak <= 4
+        assert controller.in_flight._value == 4
+        assert controller.pull_map == {}
+
+    run(test, latency=0.02, max_in_flight=4)